@@ -0,0 +1,234 @@
+"""End-to-end benchmarks of the services publishing path.
+
+Events are generated by synthetic sources (fake X desktop, files on
+tmpfs), messages go through ServicesManager and Publisher into an
+in-process broker stand-in. Reported are event to publish latency
+percentiles (events sent one by one) and messages per second (events
+sent in bursts).
+
+    python benchmarks/bench.py windows --windows 200 --sensors 20
+    python benchmarks/bench.py files --files 50 --sensors 10
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from fakes import FakeBroker, FakeClient, FakeEWMH, fake_x_sessions  # noqa: E402
+
+from mqtt4w.config import BaseConfig, PublishingModel  # noqa: E402
+from mqtt4w.manager import ServicesManager  # noqa: E402
+from mqtt4w.publisher import Publisher  # noqa: E402
+
+TMPFS = "/dev/shm"
+
+
+class Recorder:
+    """Matches published messages with the events that caused them."""
+
+    def __init__(self):
+        self.expected: Dict[Tuple[str, str], float] = {}
+        self.latencies: List[float] = []
+        self.received = 0
+        self.changed = asyncio.Event()
+
+    def expect(self, topic: str, payload: str) -> None:
+        self.expected[(topic, payload)] = time.perf_counter()
+
+    def on_publish(self, topic: str, payload: str) -> None:
+        self.received += 1
+        start = self.expected.pop((topic, payload), None)
+        if start is not None:
+            self.latencies.append(time.perf_counter() - start)
+        self.changed.set()
+
+    async def wait(self, timeout: float = 10) -> None:
+        deadline = time.perf_counter() + timeout
+        while self.expected:
+            self.changed.clear()
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise TimeoutError(f"not published: {list(self.expected)}")
+            try:
+                await asyncio.wait_for(self.changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def run_manager(
+    services, args, x_sessions=None
+) -> Tuple[ServicesManager, Recorder, asyncio.Task]:
+    broker = FakeBroker(ack_delay=args.ack_delay)
+    client = FakeClient(broker)
+    recorder = Recorder()
+    client.listeners.append(recorder.on_publish)
+    await client.connect()
+    publisher = Publisher(
+        queue_size=args.queue_size,
+        max_inflight=args.max_inflight,
+        overflow_policy=PublishingModel().overflow_policy,
+    )
+    base = BaseConfig(discovery_enabled=False)
+    manager = ServicesManager(publisher, services, **base.dict(), x_sessions=x_sessions)
+    manager.start_services()
+    serving = asyncio.ensure_future(manager.serve(client))
+    return manager, recorder, serving
+
+
+def state_topic(manager: ServicesManager, service, sensor: str) -> str:
+    return manager.topics.resolve(service.state_topic(sensor))
+
+
+def report(name: str, latencies: List[float], bursts: List[Tuple[int, float]]) -> None:
+    latencies = sorted(latencies)
+    if latencies:
+        print(f"{name}: event to publish latency, ms ({len(latencies)} samples)")
+        for percentile in (50, 90, 99, 100):
+            index = min(len(latencies) - 1, len(latencies) * percentile // 100)
+            print(f"  p{percentile:<3} {latencies[index] * 1000:9.3f}")
+    messages = sum(count for count, _ in bursts)
+    elapsed = sum(duration for _, duration in bursts)
+    if elapsed:
+        print(f"{name}: {messages / elapsed:.0f} messages/s in bursts")
+
+
+async def bench_windows(args) -> None:
+    from mqtt4w.services.windows_tracker import WindowsTrackerService
+
+    ewmh = FakeEWMH()
+    windows = [
+        ewmh.add_window(f"window {i}", notify=False) for i in range(args.windows)
+    ]
+    sensors = {f"sensor_{i}": [f"tracked {i}"] for i in range(args.sensors)}
+    service = WindowsTrackerService(
+        subtopic=Path("windows_tracker"),
+        display=None,
+        expose_active_window=False,
+        sensors=sensors,
+    )
+    manager, recorder, serving = await run_manager(
+        [service], args, fake_x_sessions(ewmh)
+    )
+    names = list(sensors)
+    for name in names:
+        recorder.expect(state_topic(manager, service, name), "OFF")
+    await recorder.wait()
+    recorder.latencies.clear()
+
+    for i in range(args.events):
+        window = random.choice(windows)
+        sensor = i % len(names)
+        recorder.expect(state_topic(manager, service, names[sensor]), "ON")
+        ewmh.set_title(window, f"tracked {sensor}")
+        await recorder.wait()
+        recorder.expect(state_topic(manager, service, names[sensor]), "OFF")
+        ewmh.set_title(window, f"window {window.id}")
+        await recorder.wait()
+    # Bursts measure throughput only
+    latencies, recorder.latencies = recorder.latencies, []
+
+    bursts = []
+    burst_windows = windows[: len(names)]
+    for _ in range(args.rounds):
+        start = time.perf_counter()
+        for state, title in (("ON", "tracked {}"), ("OFF", "window {}")):
+            for sensor, window in enumerate(burst_windows):
+                recorder.expect(state_topic(manager, service, names[sensor]), state)
+                ewmh.set_title(window, title.format(sensor))
+            await recorder.wait()
+        bursts.append((2 * len(burst_windows), time.perf_counter() - start))
+    serving.cancel()
+    report(f"windows tracker, {args.windows} windows", latencies, bursts)
+
+
+async def bench_files(args) -> None:
+    from mqtt4w.services.file_usage_tracker import FileUsageService
+
+    root = TMPFS if os.access(TMPFS, os.W_OK) else None
+    directory = tempfile.mkdtemp(prefix="mqtt4w-bench-", dir=root)
+    try:
+        files = [os.path.join(directory, f"device{i}") for i in range(args.files)]
+        for file in files:
+            open(file, "w").close()
+        sensors: Dict[str, List[str]] = {f"sensor_{i}": [] for i in range(args.sensors)}
+        names = list(sensors)
+        file_sensor = {}
+        for i, file in enumerate(files):
+            file_sensor[file] = names[i % len(names)]
+            sensors[file_sensor[file]].append(file)
+        service = FileUsageService(
+            subtopic=Path("file_usage_tracker"),
+            sensors=sensors,
+            reconcile_interval=0,
+            attributes=False,
+            attributes_interval=0,
+        )
+        manager, recorder, serving = await run_manager([service], args)
+        for name in names:
+            recorder.expect(state_topic(manager, service, name), "OFF")
+        await recorder.wait()
+        recorder.latencies.clear()
+
+        for i in range(args.events):
+            file = files[i % len(files)]
+            topic = state_topic(manager, service, file_sensor[file])
+            recorder.expect(topic, "ON")
+            opened = open(file)
+            await recorder.wait()
+            recorder.expect(topic, "OFF")
+            opened.close()
+            await recorder.wait()
+        latencies, recorder.latencies = recorder.latencies, []
+
+        bursts = []
+        for _ in range(args.rounds):
+            start = time.perf_counter()
+            for name in names:
+                recorder.expect(state_topic(manager, service, name), "ON")
+            opened_files = [open(file) for file in files]
+            await recorder.wait()
+            for name in names:
+                recorder.expect(state_topic(manager, service, name), "OFF")
+            for opened in opened_files:
+                opened.close()
+            await recorder.wait()
+            bursts.append((2 * len(names), time.perf_counter() - start))
+        serving.cancel()
+        report(f"file usage, {args.files} files", latencies, bursts)
+    finally:
+        shutil.rmtree(directory)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("source", choices=["windows", "files"])
+    parser.add_argument("--windows", type=int, default=100)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--sensors", type=int, default=10)
+    parser.add_argument("--events", type=int, default=200, help="Latency samples")
+    parser.add_argument("--rounds", type=int, default=20, help="Throughput bursts")
+    parser.add_argument("--ack-delay", type=float, default=0, help="Broker delay, s")
+    parser.add_argument("--queue-size", type=int, default=100)
+    parser.add_argument("--max-inflight", type=int, default=10)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    bench = bench_windows if args.source == "windows" else bench_files
+    asyncio.run(bench(args))
+
+
+if __name__ == "__main__":
+    main()
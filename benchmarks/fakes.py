@@ -0,0 +1,219 @@
+"""Stand-ins for the MQTT broker and the X server used by benchmarks."""
+
+import asyncio
+import itertools
+import queue
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+
+import Xlib.X
+import Xlib.error
+from asyncio_mqtt import MqttError
+from paho.mqtt.client import topic_matches_sub
+
+from mqtt4w.xsession import XSession, XSessions
+
+
+class FakeBroker:
+    """In-process broker with retained messages and a fixed ack delay."""
+
+    def __init__(self, ack_delay: float = 0):
+        self.ack_delay = ack_delay
+        self.retained: Dict[str, bytes] = {}
+        self.clients: List["FakeClient"] = []
+
+    def route(self, topic: str, payload: bytes, retain: bool) -> None:
+        if retain:
+            self.retained[topic] = payload
+        for client in self.clients:
+            client.deliver(topic, payload, False)
+
+
+class FakeClient:
+    """Implements the part of asyncio_mqtt.Client used by mqtt4w.
+
+    Like paho, keeps one callback per filter: entering filtered_messages
+    with a filter in use replaces its callback, leaving it removes the
+    filter for everyone. Unfiltered callback gets only messages which
+    no filter matched."""
+
+    def __init__(self, broker: FakeBroker):
+        self.broker = broker
+        self.subscriptions: List[str] = []
+        self.filtered: Dict[str, asyncio.Queue] = {}
+        self.unfiltered: Optional[asyncio.Queue] = None
+        self.disconnected = asyncio.Event()
+        self.listeners: List[Callable[[str, str], None]] = []
+        self.published = 0
+
+    async def connect(self) -> None:
+        self.broker.clients.append(self)
+
+    async def disconnect(self) -> None:
+        self.broker.clients.remove(self)
+        self.disconnected.set()
+
+    async def publish(self, topic, payload=None, qos=0, retain=False, **kwargs):
+        if self.disconnected.is_set():
+            raise MqttError("Disconnected")
+        if self.broker.ack_delay:
+            await asyncio.sleep(self.broker.ack_delay)
+        data = payload.encode() if isinstance(payload, str) else payload or b""
+        self.broker.route(topic, data, retain)
+        self.published += 1
+        for listener in self.listeners:
+            listener(topic, data.decode())
+
+    async def subscribe(self, topic, qos=0, **kwargs) -> None:
+        filters = [topic] if isinstance(topic, str) else [t for t, _ in topic]
+        self.subscriptions.extend(filters)
+        for topic_filter in filters:
+            for topic, payload in self.broker.retained.items():
+                if topic_matches_sub(topic_filter, topic):
+                    self.deliver(topic, payload, True)
+
+    async def unsubscribe(self, topics, **kwargs) -> None:
+        topics = [topics] if isinstance(topics, str) else topics
+        self.subscriptions = [s for s in self.subscriptions if s not in topics]
+
+    def deliver(self, topic: str, payload: bytes, retain: bool) -> None:
+        if not any(topic_matches_sub(s, topic) for s in self.subscriptions):
+            return
+        message = SimpleNamespace(topic=topic, payload=payload, retain=retain)
+        matched = [
+            messages
+            for topic_filter, messages in self.filtered.items()
+            if topic_matches_sub(topic_filter, topic)
+        ]
+        if not matched and self.unfiltered is not None:
+            matched = [self.unfiltered]
+        for messages in matched:
+            messages.put_nowait(message)
+
+    @asynccontextmanager
+    async def filtered_messages(self, topic_filter: str):
+        messages: asyncio.Queue = asyncio.Queue()
+        self.filtered[topic_filter] = messages
+        try:
+            yield self._messages(messages)
+        finally:
+            self.filtered.pop(topic_filter, None)
+
+    @asynccontextmanager
+    async def unfiltered_messages(self):
+        messages: asyncio.Queue = asyncio.Queue()
+        self.unfiltered = messages
+        try:
+            yield self._messages(messages)
+        finally:
+            self.unfiltered = None
+
+    async def _messages(self, messages: asyncio.Queue):
+        disconnected = asyncio.ensure_future(self.disconnected.wait())
+        try:
+            while True:
+                get = asyncio.ensure_future(messages.get())
+                await asyncio.wait(
+                    {get, disconnected}, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not get.done():
+                    get.cancel()
+                    raise MqttError("Disconnected during message iteration")
+                yield get.result()
+        finally:
+            disconnected.cancel()
+
+
+class FakeWindow:
+    def __init__(self, window_id: int):
+        self.id = window_id
+
+    def change_attributes(self, **kwargs) -> None:
+        pass
+
+
+class FakeDisplay:
+    """Thread safe X event source."""
+
+    def __init__(self):
+        self.events: "queue.Queue" = queue.Queue()
+        self.atoms: Dict[str, int] = defaultdict(itertools.count(1).__next__)
+        self.root = FakeWindow(0)
+
+    def get_atom(self, name: str) -> int:
+        return self.atoms[name]
+
+    def screen(self):
+        return SimpleNamespace(root=self.root)
+
+    def next_event(self):
+        event = self.events.get()
+        if event is None:
+            raise Xlib.error.ConnectionClosedError("Fake display")
+        return event
+
+    def pending_events(self) -> int:
+        return self.events.qsize()
+
+    def close(self) -> None:
+        self.events.put(None)
+
+
+class FakeEWMH:
+    """Synthetic desktop, windows are changed from benchmark code."""
+
+    def __init__(self):
+        self.display = FakeDisplay()
+        self.windows: Dict[int, FakeWindow] = {}
+        self.titles: Dict[int, bytes] = {}
+        self.active: Optional[FakeWindow] = None
+        self.ids = itertools.count(1)
+
+    def getClientList(self):
+        return list(self.windows.values())
+
+    def getWmName(self, window):
+        return self.titles.get(window.id)
+
+    def getActiveWindow(self):
+        return self.active
+
+    def getWmState(self, window, str=False):
+        return []
+
+    def property_event(self, window: FakeWindow, atom_name: str):
+        return SimpleNamespace(
+            type=Xlib.X.PropertyNotify,
+            window=window,
+            atom=self.display.get_atom(atom_name),
+            time=time.perf_counter(),
+        )
+
+    def add_window(self, title: str, notify: bool = True) -> FakeWindow:
+        window = FakeWindow(next(self.ids))
+        self.windows[window.id] = window
+        self.titles[window.id] = title.encode()
+        if notify:
+            event = self.property_event(self.display.root, "_NET_CLIENT_LIST")
+            self.display.events.put(event)
+        return window
+
+    def set_title(self, window: FakeWindow, title: str) -> None:
+        self.titles[window.id] = title.encode()
+        self.display.events.put(self.property_event(window, "_NET_WM_NAME"))
+
+
+def fake_x_sessions(ewmh: FakeEWMH) -> XSessions:
+    """Sessions of every display connect to the synthetic desktop."""
+
+    class FakeXSession(XSession):
+        def open(self) -> None:
+            self.ewmh = ewmh
+            self.display = ewmh.display
+
+    sessions = XSessions()
+    sessions.session_class = FakeXSession
+    return sessions
@@ -2,15 +2,20 @@ import argparse
 import asyncio
 import logging
 import os
+import resource
 import sys
+from typing import List
 
 from asyncio_mqtt import MqttError
 from xdg.BaseDirectory import save_config_path
 
 from mqtt4w import NAME
-from mqtt4w.client import MQTTClient
-from mqtt4w.config import load_config
-from mqtt4w.manager import ServicesManager
+from mqtt4w.client import Backoff, MQTTClient
+from mqtt4w.config import Config, LoopImplementation, load_config
+from mqtt4w.metrics import monitor_loop_lag, serve_metrics
+from mqtt4w.publisher import Publisher
+from mqtt4w.registry import ServiceTiming
+from mqtt4w.workstations import Workstations
 
 LOG = logging.getLogger(__name__)
 
@@ -25,33 +30,100 @@ def parse_args():
         default=os.path.join(save_config_path(NAME), "config.yaml"),
         help="Path to configuration file",
     )
+    args_parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="Report import and initialization time of each service",
+    )
+    args_parser.add_argument(
+        "--no-reload",
+        action="store_true",
+        help="Don't apply changes of the services configuration at runtime",
+    )
     return args_parser.parse_args()
 
 
-async def async_main():
-    args = parse_args()
-    config = load_config(args.config)
-    logging.basicConfig(**config.logging.dict())
-    LOG.info(f"Configuration file {args.config} loaded successfully")
+def report_startup(timings: List[ServiceTiming]) -> None:
+    print(f"{'service':20} {'import, ms':>12} {'init, ms':>12}")
+    for t in timings:
+        print(f"{t.name:20} {t.import_time * 1000:12.1f} {t.init_time * 1000:12.1f}")
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"Max RSS after services initialization: {max_rss} KiB")
+
+
+def install_event_loop(implementation: LoopImplementation) -> None:
+    if implementation != LoopImplementation.UVLOOP:
+        return
+    try:
+        import uvloop
+    except ImportError:
+        LOG.warning("uvloop is not installed, falling back to asyncio event loop")
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    LOG.info("Using uvloop event loop")
+
+
+def start_monitoring(config: Config) -> List[asyncio.Task]:
+    """Lag probe runs always, so blocked loop is logged without metrics."""
+    if config.event_loop.debug:
+        loop = asyncio.get_running_loop()
+        loop.set_debug(True)
+        loop.slow_callback_duration = config.event_loop.lag_warning
+    tasks = [
+        asyncio.ensure_future(
+            monitor_loop_lag(
+                config.metrics.loop_lag_interval, config.event_loop.lag_warning
+            )
+        )
+    ]
+    if config.metrics.enabled:
+        tasks.append(
+            asyncio.ensure_future(
+                serve_metrics(config.metrics.host, config.metrics.port)
+            )
+        )
+    return tasks
+
+
+async def async_main(args: argparse.Namespace, config: Config):
+    timings = [] if args.profile_startup else None
+    publisher = Publisher(**config.publishing.dict())
+    workstations = Workstations(config, publisher, timings)
+    if timings is not None:
+        report_startup(timings)
+    # Keep references, otherwise tasks may be garbage collected
+    background_tasks = start_monitoring(config)
+    workstations.start_services()
+    if not args.no_reload:
+        # Reloader pulls in asyncinotify, not needed with --no-reload
+        from mqtt4w.reloader import ConfigReloader
+
+        reloader = ConfigReloader(args.config, config, workstations)
+        background_tasks.append(asyncio.ensure_future(reloader.watch()))
+    backoff = Backoff(**config.mqtt.reconnect.dict())
     running = True
     while running:
         try:
-            avail_topic = (
-                config.base.base_topic
-                / config.base.workstation_name
-                / config.base.availability_subtopic
+            client = MQTTClient(
+                avail_topic=workstations.availability_topic,
+                **config.mqtt.dict(exclude={"reconnect"}),
             )
-            client = MQTTClient(avail_topic=avail_topic, **config.mqtt.dict())
             await client.connect()
             LOG.info("Connected to MQTT server")
-            services = [cfg.create_instance() for cfg in config.services.list()]
-            manager = ServicesManager(client, services, **config.base.dict())
-            await manager.start_all()
+            backoff.reset()
+            await workstations.serve(client)
         except MqttError as error:
             LOG.error(f"Error: {error}")
-            logging.info("Waiting and reconnecting")
-            await asyncio.sleep(60)
+            delay = backoff.next_delay()
+            LOG.info(f"Reconnecting in {delay:.1f} seconds")
+            await asyncio.sleep(delay)
 
 
 def main():
-    sys.exit(asyncio.run(async_main()))
+    args = parse_args()
+    config = load_config(args.config)
+    logging.basicConfig(**config.logging.dict())
+    LOG.info(f"Configuration file {args.config} loaded successfully")
+    # Loop implementation is chosen before the loop is created
+    install_event_loop(config.event_loop.implementation)
+    sys.exit(asyncio.run(async_main(args, config)))
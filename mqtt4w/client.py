@@ -1,3 +1,5 @@
+import random
+
 from asyncio_mqtt import Client, Will
 
 from mqtt4w.services.common.constants import OFFLINE
@@ -13,3 +15,22 @@ class MQTTClient(Client):
             password=password,
             will=will,
         )
+
+
+class Backoff:
+    """Exponential reconnect delay with jitter."""
+
+    def __init__(self, min_delay: float, max_delay: float):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.attempt = 0
+
+    def reset(self) -> None:
+        self.attempt = 0
+
+    def next_delay(self) -> float:
+        delay = min(self.max_delay, self.min_delay * 2**self.attempt)
+        if delay < self.max_delay:
+            # Stop at the cap, otherwise the power overflows float
+            self.attempt += 1
+        return random.uniform(delay / 2, delay)
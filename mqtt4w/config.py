@@ -1,23 +1,32 @@
+from enum import Enum
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 import yaml
-from pydantic import BaseModel
+from pydantic import BaseModel, PositiveFloat, PositiveInt, validator
 
+from mqtt4w.publisher import OverflowPolicy
+from mqtt4w.registry import DEFAULT_SERVICES
 from mqtt4w.services.common.discovery import UNIQUE_ID
-from mqtt4w.services.dpms import ServiceModel as DPMSModel
-from mqtt4w.services.file_usage_tracker import ServiceModel as FileUsageModel
-from mqtt4w.services.windows_tracker import ServiceModel as WindowTrackerModel
+from mqtt4w.services.common.topics import normalize_level
 
 
 class ServicesModel(BaseModel):
-    windows_tracker: WindowTrackerModel = WindowTrackerModel()
-    file_usage: FileUsageModel = FileUsageModel()
-    dpms: DPMSModel = DPMSModel()
+    """Raw service sections, validated by service models when loaded."""
 
-    def list(self):
-        # return [self.windows_tracker, self.file_usage, self.dpms]
-        return [self.dpms, self.file_usage]
+    __root__: Dict[str, Optional[Dict[str, Any]]] = {}
+
+    def enabled(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        sections = {name: {} for name in DEFAULT_SERVICES}
+        sections.update((k, dict(v or {})) for k, v in self.__root__.items())
+        for name, section in sections.items():
+            if section.pop("enabled", True):
+                yield name, section
+
+
+class ReconnectModel(BaseModel):
+    min_delay: PositiveFloat = 1
+    max_delay: PositiveFloat = 300
 
 
 class MqttModel(BaseModel):
@@ -25,6 +34,36 @@ class MqttModel(BaseModel):
     port: int = 1883
     username: str
     password: str
+    reconnect: ReconnectModel = ReconnectModel()
+
+
+class PublishingModel(BaseModel):
+    queue_size: PositiveInt = 100
+    max_inflight: PositiveInt = 10
+    overflow_policy: OverflowPolicy = OverflowPolicy.BLOCK
+
+
+class MetricsModel(BaseModel):
+    enabled: bool = False
+    host: str = "127.0.0.1"
+    port: PositiveInt = 9101
+    loop_lag_interval: PositiveFloat = 1
+
+
+class LoopImplementation(str, Enum):
+    ASYNCIO = "asyncio"
+    UVLOOP = "uvloop"
+
+
+class EventLoopModel(BaseModel):
+    # uvloop is used only if installed (mqtt4w[uvloop] extra)
+    implementation: LoopImplementation = LoopImplementation.ASYNCIO
+    # Lag probes (every metrics.loop_lag_interval) longer than this are
+    # logged, something blocked the loop
+    lag_warning: PositiveFloat = 0.1
+    # asyncio debug mode names callbacks running longer than lag_warning,
+    # it slows down the loop, so use it only to find the culprit
+    debug: bool = False
 
 
 class LoggingModel(BaseModel):
@@ -40,14 +79,57 @@ class BaseConfig(BaseModel):
     base_topic: Path = Path("mqtt4w")
     discovery_enabled: bool = True
     discovery_prefix: Path = Path("homeassistant")
+    discovery_sync_timeout: PositiveFloat = 1
     availability_subtopic: Path = Path("available")
+    receiver_threads: PositiveInt = 4
+    probe_threads: PositiveInt = 2
+
+
+class WorkstationModel(BaseModel):
+    workstation_name: str
+    # Derived from base workstation_id and the name if not set
+    workstation_id: Optional[str] = None
+    # X display used by services which don't set their own
+    display: Optional[str] = None
+    services: ServicesModel = ServicesModel()
 
 
 class Config(BaseModel):
     base: BaseConfig = BaseConfig()
     mqtt: MqttModel
+    publishing: PublishingModel = PublishingModel()
     logging: LoggingModel = LoggingModel()
+    metrics: MetricsModel = MetricsModel()
+    event_loop: EventLoopModel = EventLoopModel()
     services: ServicesModel = ServicesModel()
+    # Seats served over one connection, base and services sections
+    # describe the only workstation if empty
+    workstations: List[WorkstationModel] = []
+
+    @validator("workstations")
+    def check_unique_names(cls, workstations):
+        names = [normalize_level(w.workstation_name) for w in workstations]
+        if len(set(names)) != len(names):
+            raise ValueError("Workstation names should be unique")
+        return workstations
+
+    def workstation_configs(self) -> List[WorkstationModel]:
+        if not self.workstations:
+            return [
+                WorkstationModel(
+                    workstation_name=self.base.workstation_name,
+                    workstation_id=self.base.workstation_id,
+                    services=self.services,
+                )
+            ]
+        configs = []
+        for workstation in self.workstations:
+            name = normalize_level(workstation.workstation_name)
+            workstation_id = workstation.workstation_id
+            if not workstation_id:
+                workstation_id = f"{self.base.workstation_id}_{name}"
+            configs.append(workstation.copy(update={"workstation_id": workstation_id}))
+        return configs
 
 
 def load_config(config_path: str) -> Config:
@@ -1,19 +1,136 @@
 import asyncio
+import logging
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
 from pathlib import Path
-from typing import AsyncGenerator, Callable, Coroutine, List, Optional
+from typing import (
+    AsyncGenerator,
+    Callable,
+    Coroutine,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 
 from asyncio_mqtt.client import Client
 
+from mqtt4w.metrics import REGISTRY
+from mqtt4w.publisher import Publisher
+from mqtt4w.scheduler import Scheduler
 from mqtt4w.services.common import Message
 from mqtt4w.services.common.baseservice import BaseService
-from mqtt4w.services.common.constants import OFFLINE, ONLINE
-from mqtt4w.services.common.discovery import expand_discovery_entity
+from mqtt4w.services.common.constants import HA_ONLINE, OFFLINE, ONLINE
+from mqtt4w.services.common.discovery import (
+    expand_discovery_entity,
+    payload_digest,
+)
+from mqtt4w.services.common.structures import Receiver
+from mqtt4w.services.common.topics import (
+    Topic,
+    TopicRegistry,
+    TopicTrie,
+    normalize_level,
+)
+from mqtt4w.services.common.utils import debounce_messages
+from mqtt4w.xsession import XSessions
+
+LOG = logging.getLogger(__name__)
+
+MESSAGES = REGISTRY.counter(
+    "mqtt4w_messages_total", "Messages produced by services", ["service"]
+)
+SEND_DURATION = REGISTRY.histogram(
+    "mqtt4w_send_message_seconds",
+    "Time spent in send_message, includes waiting for queue space",
+    ["service"],
+)
+RECEIVED = REGISTRY.counter("mqtt4w_received_total", "Dispatched commands")
+
+
+async def run_until_failure(*coros) -> None:
+    """Run coroutines concurrently, cancel the rest when one of them fails."""
+    tasks = {asyncio.ensure_future(c) for c in coros}
+    try:
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            errors = [t.exception() for t in done if not t.cancelled()]
+            errors = [e for e in errors if e]
+            if errors:
+                raise errors[0]
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def watch_connection(client: Client) -> None:
+    # Message iteration raises MqttError once client is disconnected
+    async with client.unfiltered_messages() as messages:
+        async for _ in messages:
+            pass
+
+
+async def sync_discovery(client: Client, managers: Sequence["ServicesManager"]) -> None:
+    """Publish discovery configs which differ from retained on the broker.
+
+    Broker sends retained copies right after subscription, so config
+    topics of all managers are listened to for discovery_sync_timeout
+    seconds. paho keeps a single callback per filter, managers sharing
+    a connection (and discovery prefix) get copies from one listener."""
+    managers = [m for m in managers if m.discovery]
+    if not managers:
+        return
+    topics = [t for m in managers for t in m.discovery]
+    wanted = set(topics)
+    retained: Dict[str, str] = {}
+    loop = asyncio.get_running_loop()
+    prefix = managers[0].discovery_prefix
+    timeout = max(m.discovery_sync_timeout for m in managers)
+    async with client.filtered_messages(f"{prefix}/#") as messages:
+        await client.subscribe([(t, 1) for t in topics])
+        deadline = loop.time() + timeout
+        try:
+            while len(retained) < len(wanted):
+                message = await asyncio.wait_for(
+                    messages.__anext__(), deadline - loop.time()
+                )
+                if message.retain and message.topic in wanted:
+                    retained[message.topic] = payload_digest(message.payload)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            await client.unsubscribe(topics)
+    for manager in managers:
+        await manager.publish_discovery(retained)
+
+
+async def watch_homeassistant(
+    client: Client, managers: Sequence["ServicesManager"]
+) -> None:
+    """Resync discovery and states of all managers when Home Assistant
+    comes online, through one subscription for the whole connection."""
+    managers = [m for m in managers if m.discovery_enabled]
+    if not managers:
+        return
+    topic = managers[0].homeassistant_status_topic
+    async with client.filtered_messages(topic) as messages:
+        await client.subscribe(topic, qos=1)
+        async for message in messages:
+            if message.retain or message.payload.decode() != HA_ONLINE:
+                continue
+            LOG.info("Home Assistant is online, republishing states")
+            await sync_discovery(client, managers)
+            for manager in managers:
+                await manager.resync()
 
 
 class ServicesManager:
     def __init__(
         self,
-        client: Client,
+        publisher: Publisher,
         services: List[BaseService],
         *,
         workstation_id: str,
@@ -21,75 +138,264 @@ class ServicesManager:
         base_topic: Path,
         discovery_prefix: Path,
         discovery_enabled: bool,
+        discovery_sync_timeout: float,
         availability_subtopic: Path,
+        receiver_threads: int,
+        probe_threads: int,
+        display: Optional[str] = None,
+        connection_availability_topic: Optional[Path] = None,
+        scheduler: Optional[Scheduler] = None,
+        receivers_executor: Optional[Executor] = None,
+        x_sessions: Optional[XSessions] = None,
     ):
+        """Scheduler, executor and X sessions may be shared between
+        managers of several workstations, then their owner runs them."""
         self.running: bool = False
-        self.mqtt_client = client
-        self.base_topic = base_topic
+        self.mqtt_client: Optional[Client] = None
+        self.publisher = publisher
         self.workstation_id = workstation_id
         self.workstation_name = workstation_name
-        # TODO: normalize workstation name when using it as part of path!
-        self.base_topic /= self.workstation_name
+        self.base_topic = base_topic / normalize_level(workstation_name)
+        self.topics = TopicRegistry(str(self.base_topic))
         self.discovery_prefix = discovery_prefix
         self.discovery_enabled = discovery_enabled
-        self.availability_topic = base_topic / workstation_name / availability_subtopic
-        self.tasks = set()
+        self.discovery_sync_timeout = discovery_sync_timeout
+        self.discovery: Dict[str, Tuple[str, str]] = {}
+        self.service_discovery: Dict[BaseService, List[str]] = {}
+        self.availability_topic = self.base_topic / availability_subtopic
+        # Last will of a connection shared by several workstations
+        self.availability_topics = [self.availability_topic]
+        if connection_availability_topic not in (None, self.availability_topic):
+            self.availability_topics.insert(0, connection_availability_topic)
+        self.display = display
+        self.homeassistant_status_topic = str(discovery_prefix / "status")
+        self.last_values: Dict[str, Tuple[Union[str, bytes], bool]] = {}
+        self.services: List[BaseService] = []
+        self.tasks: Dict[BaseService, List[Coroutine]] = {}
+        self.running_tasks: Dict[BaseService, Set[asyncio.Task]] = {}
+        self.scheduler_task: Optional[asyncio.Task] = None
+        self.receivers = TopicTrie()
+        # Keep references, otherwise receiver tasks may be garbage collected
+        self.receiver_tasks: Set[asyncio.Future] = set()
+        self.subscribed: Set[str] = set()
+        self.receivers_executor = receivers_executor or ThreadPoolExecutor(
+            max_workers=receiver_threads, thread_name_prefix="receiver"
+        )
+        self.owns_scheduler = scheduler is None
+        if scheduler is None:
+            scheduler = Scheduler(probe_threads)
+        self.scheduler = scheduler
+        self.x_sessions = XSessions() if x_sessions is None else x_sessions
         for s in services:
             self.add_service(s)
 
     def add_service(self, service: BaseService) -> None:
-        for initializer in service.initializers:
-            self.tasks.add(initializer())
+        self.services.append(service)
+        for display, attach in service.x_clients:
+            self.x_sessions.add_client(display or self.display, service, attach)
+        for topic in service.topics:
+            self.topics.register(topic)
+            topic.retain = service.retains(topic)
+        tasks = [initializer() for initializer in service.initializers]
         for sender in service.senders:
-            self.tasks.add(self._send_from(sender))
-        # for receiver in service.receivers:
-        #     if receiver
-        # if service.incoming_msg:
-        #     service_topic = self.base_topic / service.subtopic
-        #     subscription_topic = service_topic / "#"
-        #     self.tasks.add(self.mqtt_client.subscribe(str(subscription_topic)))
-        #     messages = self.mqtt_client.filtered_messages(str(service_topic))
-        #     self.tasks.add(
-        #         self._receive_to(
-        #             messages, str(subscription_topic), service.incoming_msg
-        #         )
-        #     )
+            tasks.append(self._send_from(sender, service))
+        for probe in service.probes:
+            self.scheduler.add(probe)
+            tasks.append(self._send_from(probe.produce, service))
+        self.tasks[service] = tasks
+        for receiver in service.receivers:
+            self.receivers.insert(receiver.subtopic, receiver)
         if self.discovery_enabled:
-            self.tasks.add(self.advertise_service(service))
+            self.prepare_discovery(service)
+        if self.running:
+            self.start_service(service)
 
-    async def advertise_service(self, service: BaseService):
+    def remove_service(self, service: BaseService) -> None:
+        """Stop service and forget everything it registered."""
+        self.services.remove(service)
+        for coro in self.tasks.pop(service, []):
+            coro.close()
+        for task in self.running_tasks.pop(service, set()):
+            task.cancel()
+        for probe in service.probes:
+            self.scheduler.remove(probe)
+        for receiver in service.receivers:
+            self.receivers.remove(receiver.subtopic, receiver)
+        for topic in service.topics:
+            self.last_values.pop(str(topic.full), None)
+            self.topics.unregister(topic)
+        for topic in self.service_discovery.pop(service, []):
+            del self.discovery[topic]
+        for finalizer in service.finalizers:
+            try:
+                finalizer()
+            except Exception:
+                LOG.exception(f"Failed to stop {type(service).__name__}")
+        self.x_sessions.remove_clients(service)
+
+    async def replace_services(
+        self, removed: List[BaseService], added: List[BaseService]
+    ) -> None:
+        """Swap services at runtime and update broker state accordingly.
+
+        Discovery configs are published only for new or changed entities,
+        configs of entities which are gone are cleared with empty retained
+        payloads, so Home Assistant removes them."""
+        discovery = dict(self.discovery)
+        for service in removed:
+            self.remove_service(service)
+        for service in added:
+            self.add_service(service)
+        if self.mqtt_client:
+            await self.update_subscriptions(self.mqtt_client)
+        for topic in discovery.keys() - self.discovery.keys():
+            await self.publisher.put(topic, "", retain=True)
+        for topic, (payload, digest) in self.discovery.items():
+            if topic not in discovery or discovery[topic][1] != digest:
+                await self.publisher.put(topic, payload, retain=True)
+
+    def prepare_discovery(self, service: BaseService) -> None:
+        topics = self.service_discovery.setdefault(service, [])
         for entity in service.discoveries:
             message = expand_discovery_entity(
                 entity,
                 self.workstation_id,
                 self.base_topic,
                 self.workstation_name,
-                self.availability_topic,
+                self.availability_topics,
             )
-            await self.send_message(message)
+            topic = str(self.discovery_prefix / message.topic)
+            digest = payload_digest(message.payload.encode())
+            self.discovery[topic] = (message.payload, digest)
+            topics.append(topic)
+
+    async def publish_discovery(self, retained: Dict[str, str]) -> None:
+        """Publish configs which digests differ from retained ones."""
+        outdated = [t for t, (_, d) in self.discovery.items() if retained.get(t) != d]
+        LOG.info(
+            f"{len(outdated)} of {len(self.discovery)} discovery configs "
+            f"of {self.workstation_name} to publish"
+        )
+        for topic in outdated:
+            await self.publisher.put(topic, self.discovery[topic][0], retain=True)
 
     async def send_message(self, message: Message):
+        retain = False
         if message.discovery:
-            topic = self.discovery_prefix / message.topic
+            topic = str(self.discovery_prefix / message.topic)
         else:
-            topic = self.base_topic / message.topic
-        payload = message.payload
-        await self.mqtt_client.publish(str(topic), payload, qos=1)
+            topic = self.topics.resolve(message.topic)
+            retain = isinstance(message.topic, Topic) and message.topic.retain
+        self.last_values[topic] = (message.payload, retain)
+        await self.publisher.put(topic, message.payload, retain)
+
+    async def resync(self, connected: bool = False) -> None:
+        """Republish last known value of every topic.
 
-    async def start_all(self) -> None:
+        Newer queued values are not overridden. Right after connection
+        values kept over reconnect are skipped even if a worker already
+        took them, otherwise they would be published twice."""
+        for topic, (payload, retain) in list(self.last_values.items()):
+            if not self.publisher.queued(topic, sent=connected):
+                await self.publisher.put(topic, payload, retain)
+
+    def start_services(self) -> None:
+        """Start services, they keep running across broker reconnects."""
         self.running = True
-        await self.mqtt_client.publish(str(self.availability_topic), ONLINE)
-        await asyncio.gather(*self.tasks)
-        await self.mqtt_client.publish(str(self.availability_topic), OFFLINE)
+        if self.owns_scheduler:
+            self.scheduler_task = asyncio.ensure_future(self.scheduler.run())
+            self.scheduler_task.add_done_callback(self._service_task_done)
+        for service in list(self.tasks):
+            self.start_service(service)
+
+    def start_service(self, service: BaseService) -> None:
+        tasks = self.running_tasks.setdefault(service, set())
+        for coro in self.tasks.pop(service):
+            task = asyncio.ensure_future(coro)
+            task.add_done_callback(tasks.discard)
+            task.add_done_callback(self._service_task_done)
+            tasks.add(task)
+
+    async def serve(self, client: Client) -> None:
+        """Publish through the client until connection is lost."""
+        self.publisher.attach(client)
+        try:
+            await run_until_failure(
+                self.publisher.run(),
+                watch_connection(client),
+                watch_homeassistant(client, [self]),
+                sync_discovery(client, [self]),
+                self.serve_workstation(client),
+            )
+        finally:
+            self.publisher.detach()
+
+    async def serve_workstation(self, client: Client) -> None:
+        """Topics of this workstation, publisher, discovery sync and
+        Home Assistant status are run by the caller."""
+        self.mqtt_client = client
+        try:
+            await client.publish(
+                str(self.availability_topic), ONLINE, qos=1, retain=True
+            )
+            await run_until_failure(self.resync(connected=True), self._receive(client))
+        finally:
+            self.mqtt_client = None
+
+    def _service_task_done(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception():
+            LOG.error("Service task failed", exc_info=task.exception())
 
-    async def _send_from(self, messages_get) -> None:
-        async for message in messages_get():
+    async def _send_from(self, messages_get, service: BaseService) -> None:
+        messages = messages_get()
+        if service.debounced:
+            messages = debounce_messages(messages, service.settle_time)
+        name = type(service).__name__
+        async for message in messages:
+            start = time.perf_counter()
             await self.send_message(message)
+            SEND_DURATION.observe(time.perf_counter() - start, name)
+            MESSAGES.inc(name)
+
+    async def update_subscriptions(self, client: Client) -> None:
+        """Bring broker subscriptions in line with receivers filters.
+
+        Broker gets all new filters in one SUBSCRIBE packet, subscribing
+        to the whole base topic would echo back every published state."""
+        base = str(self.base_topic)
+        filters = {f"{base}/{f}" for f in self.receivers.filters()}
+        new, gone = filters - self.subscribed, self.subscribed - filters
+        self.subscribed = filters
+        if new:
+            await client.subscribe([(f, 1) for f in sorted(new)])
+        if gone:
+            await client.unsubscribe(sorted(gone))
 
-    async def _receive_to(self, messages, subtopic, incoming_queue):
-        preamble = len(subtopic) + 1  # +1 for "/" in base/topic/subtopic
-        async with messages as m:
-            async for message in m:
+    async def _receive(self, client: Client) -> None:
+        base = str(self.base_topic)
+        preamble = len(base) + 1  # +1 for "/" in base/subtopic
+        async with client.filtered_messages(f"{base}/#") as messages:
+            # Subscriptions don't survive reconnect (clean session)
+            self.subscribed = set()
+            await self.update_subscriptions(client)
+            async for message in messages:
                 topic = message.topic[preamble:]
-                parsed_message = Message(topic, message.payload.decode())
-                await incoming_queue.put(parsed_message)
+                for receiver in self.receivers.match(topic):
+                    self.dispatch(receiver, Message(topic, message.payload.decode()))
+
+    def dispatch(self, receiver: Receiver, message: Message) -> None:
+        RECEIVED.inc()
+        if receiver.asynchronous:
+            task = asyncio.ensure_future(receiver.function(message))
+        else:
+            loop = asyncio.get_running_loop()
+            task = loop.run_in_executor(
+                self.receivers_executor, receiver.function, message
+            )
+        self.receiver_tasks.add(task)
+        task.add_done_callback(self.receiver_tasks.discard)
+        task.add_done_callback(self._receiver_done)
+
+    def _receiver_done(self, task: asyncio.Future) -> None:
+        if not task.cancelled() and task.exception():
+            LOG.error("Receiver failed", exc_info=task.exception())
@@ -0,0 +1,200 @@
+"""Lightweight instrumentation.
+
+Metrics are plain in-process counters, updating one costs a dict
+lookup. They can be exposed in Prometheus text format over HTTP and
+(via the metrics service) as MQTT sensors."""
+
+import asyncio
+import bisect
+import logging
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+LOG = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+# Blocked loop is reported at most once per period
+LAG_WARNING_PERIOD = 60
+
+Labels = Tuple[str, ...]
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values: Dict[Labels, float] = defaultdict(float)
+
+    def value(self, *labels: str) -> float:
+        return self.values.get(labels, 0)
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def samples(self) -> Iterator[Tuple[str, Labels, float]]:
+        for labels, value in self.values.items():
+            yield self.name, labels, value
+
+    def format_labels(self, labels: Labels, extra: str = "") -> str:
+        pairs = [f'{k}="{v}"' for k, v in zip(self.labels, labels)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}"]
+        lines.append(f"# TYPE {self.name} {self.type}")
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{self.format_labels(labels)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self.values[labels] += amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, *labels: str) -> None:
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self.counts: Dict[Labels, List[int]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        if labels not in self.counts:
+            self.counts[labels] = [0] * (len(self.buckets) + 1)
+        self.counts[labels][bisect.bisect_left(self.buckets, value)] += 1
+        self.values[labels] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}"]
+        lines.append(f"# TYPE {self.name} {self.type}")
+        for labels, counts in self.counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound}"
+                bucket_labels = self.format_labels(labels, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            formatted = self.format_labels(labels)
+            lines.append(f"{self.name}_sum{formatted} {self.values[labels]}")
+            lines.append(f"{self.name}_count{formatted} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labels=()) -> Counter:
+        return self.register(Counter(name, documentation, labels))  # type: ignore
+
+    def gauge(self, name: str, documentation: str, labels=()) -> Gauge:
+        return self.register(Gauge(name, documentation, labels))  # type: ignore
+
+    def histogram(self, name: str, documentation: str, labels=(), **kwargs):
+        return self.register(Histogram(name, documentation, labels, **kwargs))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+LOOP_LAG = REGISTRY.gauge(
+    "mqtt4w_event_loop_lag_seconds", "Delay of the last event loop lag probe"
+)
+LOOP_LAG_HISTOGRAM = REGISTRY.histogram(
+    "mqtt4w_event_loop_lag_probe_seconds", "Event loop lag probes"
+)
+LOOP_STALLS = REGISTRY.counter(
+    "mqtt4w_event_loop_stalls_total", "Lag probes above the warning threshold"
+)
+
+
+async def monitor_loop_lag(
+    interval: float, warning_threshold: Optional[float] = None
+) -> None:
+    """Measure how late the event loop wakes up a sleeping task.
+
+    Lag above warning_threshold means some code blocked the loop, such
+    probes are counted and summarized in a warning once per period."""
+    loop = asyncio.get_running_loop()
+    stalls, worst, next_warning = 0, 0.0, 0.0
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        now = loop.time()
+        lag = max(now - start - interval, 0)
+        LOOP_LAG.set(lag)
+        LOOP_LAG_HISTOGRAM.observe(lag)
+        if warning_threshold is None or lag <= warning_threshold:
+            continue
+        LOOP_STALLS.inc()
+        stalls, worst = stalls + 1, max(worst, lag)
+        if now >= next_warning:
+            LOG.warning(
+                f"Event loop was blocked {stalls} time(s), for up to "
+                f"{worst * 1000:.0f} ms, enable event_loop.debug to find "
+                "the blocking callback"
+            )
+            stalls, worst, next_warning = 0, 0.0, now + LAG_WARNING_PERIOD
+
+
+async def handle_request(reader, writer) -> None:
+    try:
+        request_line = await reader.readline()
+        while await reader.readline() not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[0] == b"GET" and parts[1] == b"/metrics":
+            status = "200 OK"
+            body = REGISTRY.render().encode()
+        else:
+            status = "404 Not Found"
+            body = b"Not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_metrics(host: str, port: int) -> None:
+    server = await asyncio.start_server(handle_request, host, port)
+    LOG.info(f"Serving metrics on http://{host}:{port}/metrics")
+    async with server:
+        await server.serve_forever()
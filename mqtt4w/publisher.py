@@ -0,0 +1,134 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from enum import Enum
+from typing import Any, Optional, Set, Tuple, Union
+
+from asyncio_mqtt import MqttError
+from asyncio_mqtt.client import Client
+
+from mqtt4w.metrics import REGISTRY
+
+LOG = logging.getLogger(__name__)
+
+PUBLISHED = REGISTRY.counter("mqtt4w_published_total", "Messages acknowledged")
+DROPPED = REGISTRY.counter("mqtt4w_dropped_total", "Messages dropped on overflow")
+QUEUE_DEPTH = REGISTRY.gauge("mqtt4w_publish_queue_depth", "Queued messages")
+PUBLISH_LATENCY = REGISTRY.histogram(
+    "mqtt4w_publish_seconds", "Time from publish to broker acknowledgement"
+)
+
+
+Item = Tuple[str, Union[str, bytes], bool]
+
+
+class OverflowPolicy(str, Enum):
+    BLOCK = "block"
+    DROP_OLDEST = "drop_oldest"
+    LATEST = "latest"
+
+
+class Publisher:
+    """Bounded queue of outgoing messages served by several workers.
+
+    Up to max_inflight QoS 1 publishes wait for broker acknowledgement
+    simultaneously, so a slow round-trip doesn't stall the senders.
+    When the queue is full, overflow_policy decides what happens:
+    block the sender, drop the oldest queued message or (with "latest")
+    replace queued value for the same topic and block otherwise."""
+
+    def __init__(
+        self,
+        client: Optional[Client] = None,
+        *,
+        queue_size: int,
+        max_inflight: int,
+        overflow_policy: OverflowPolicy,
+    ):
+        self.client = client
+        self.queue_size = queue_size
+        self.max_inflight = max_inflight
+        self.overflow_policy = overflow_policy
+        self.pending: "OrderedDict[Any, Item]" = OrderedDict()
+        self.changed = asyncio.Condition()
+        self.counter = itertools.count()
+        self.dropped = 0
+        self.connected = False
+        # Topics taken by workers since attach
+        self.sent: Set[str] = set()
+
+    def attach(self, client: Client) -> None:
+        self.client = client
+        self.connected = True
+        self.sent.clear()
+
+    def detach(self) -> None:
+        """Stop publishing and keep only the last queued value per topic.
+
+        Until next attach all values queued for the same topic coalesce,
+        so only the last known state is sent after reconnect."""
+        self.connected = False
+        compacted: "OrderedDict[Any, Item]" = OrderedDict()
+        for item in self.pending.values():
+            compacted.pop(item[0], None)
+            compacted[item[0]] = item
+        self.pending = compacted
+
+    async def put(
+        self, topic: str, payload: Union[str, bytes], retain: bool = False
+    ) -> None:
+        latest = self.overflow_policy == OverflowPolicy.LATEST or not self.connected
+        async with self.changed:
+            if latest and topic in self.pending:
+                self.pending[topic] = (topic, payload, retain)
+                return
+            if len(self.pending) >= self.queue_size:
+                if self.overflow_policy == OverflowPolicy.DROP_OLDEST:
+                    dropped_topic, _, _ = self.pending.popitem(last=False)[1]
+                    self.dropped += 1
+                    DROPPED.inc()
+                    LOG.warning(f"Outgoing queue is full, dropped {dropped_topic}")
+                else:
+                    await self.changed.wait_for(
+                        lambda: len(self.pending) < self.queue_size
+                    )
+            key = topic if latest else next(self.counter)
+            self.pending[key] = (topic, payload, retain)
+            QUEUE_DEPTH.set(len(self.pending))
+            self.changed.notify_all()
+
+    def queued(self, topic: str, sent: bool = False) -> bool:
+        """Whether a value of the topic waits in the queue, with sent
+        also whether one was taken by a worker since attach."""
+        if sent and topic in self.sent:
+            return True
+        return any(item[0] == topic for item in self.pending.values())
+
+    async def run(self) -> None:
+        await asyncio.gather(*(self._worker() for _ in range(self.max_inflight)))
+
+    async def _worker(self) -> None:
+        while True:
+            async with self.changed:
+                await self.changed.wait_for(lambda: self.pending)
+                key, item = self.pending.popitem(last=False)
+                self.sent.add(item[0])
+                QUEUE_DEPTH.set(len(self.pending))
+                self.changed.notify_all()
+            start = time.perf_counter()
+            try:
+                await self.client.publish(item[0], item[1], qos=1, retain=item[2])
+            except (MqttError, asyncio.CancelledError):
+                self.requeue(key, item)
+                raise
+            PUBLISH_LATENCY.observe(time.perf_counter() - start)
+            PUBLISHED.inc()
+
+    def requeue(self, key: Any, item: Item) -> None:
+        if item[0] in self.pending:
+            # Newer value for the same topic is already waiting
+            return
+        self.pending[key] = item
+        self.pending.move_to_end(key, last=False)
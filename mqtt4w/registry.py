@@ -0,0 +1,80 @@
+"""Services lookup.
+
+Service modules pull in heavy dependencies (Xlib, inotify, ctypes
+libraries), so they are imported only when their service is enabled.
+Third party services are found through the "mqtt4w.services" entry
+points group, entry point should name the module or its config model."""
+
+import importlib
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Type
+
+from mqtt4w.services.common.baseservice import BaseService
+from mqtt4w.services.common.config import ServiceBaseModel, ServiceConfigError
+
+LOG = logging.getLogger(__name__)
+
+ENTRY_POINTS_GROUP = "mqtt4w.services"
+BUILTIN_SERVICES = {
+    "windows_tracker": "mqtt4w.services.windows_tracker",
+    "file_usage": "mqtt4w.services.file_usage_tracker",
+    "dpms": "mqtt4w.services.dpms",
+    "metrics": "mqtt4w.services.metrics",
+}
+# Enabled even without configuration section
+DEFAULT_SERVICES = ("dpms", "file_usage")
+MODEL_NAME = "ServiceModel"
+
+
+@dataclass
+class ServiceTiming:
+    name: str
+    import_time: float = 0
+    init_time: float = 0
+
+
+def entry_points() -> Dict[str, str]:
+    try:
+        from importlib.metadata import entry_points as get_entry_points
+    except ImportError:  # python < 3.8
+        return {}
+    found = get_entry_points()
+    if hasattr(found, "select"):
+        group = found.select(group=ENTRY_POINTS_GROUP)
+    else:
+        group = found.get(ENTRY_POINTS_GROUP, [])
+    return {ep.name: ep.value for ep in group}
+
+
+def available_services() -> Dict[str, str]:
+    return {**entry_points(), **BUILTIN_SERVICES}
+
+
+def load_model(reference: str) -> Type[ServiceBaseModel]:
+    module_name, _, attribute = reference.partition(":")
+    module = importlib.import_module(module_name)
+    return getattr(module, attribute or MODEL_NAME)
+
+
+def create_services(
+    sections: Iterable[Tuple[str, Dict[str, Any]]],
+    timings: Optional[List[ServiceTiming]] = None,
+) -> List[BaseService]:
+    services = []
+    references = available_services()
+    for name, section in sections:
+        if name not in references:
+            raise ServiceConfigError(f"Unknown service {name}")
+        timing = ServiceTiming(name)
+        start = time.perf_counter()
+        model = load_model(references[name])
+        timing.import_time = time.perf_counter() - start
+        start = time.perf_counter()
+        services.append(model(**section).create_instance())
+        timing.init_time = time.perf_counter() - start
+        LOG.debug(f"Service {name} created")
+        if timings is not None:
+            timings.append(timing)
+    return services
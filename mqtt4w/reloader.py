@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import os
+from typing import Any, Dict, List
+
+from asyncinotify import Inotify, Mask
+
+from mqtt4w.config import Config, load_config
+from mqtt4w.registry import create_services
+from mqtt4w.workstations import Workstation, Workstations
+
+LOG = logging.getLogger(__name__)
+
+# Editors save files in several steps (truncate, write, rename)
+SETTLE_TIME = 0.5
+WATCH_MASK = Mask.CLOSE_WRITE | Mask.MOVED_TO | Mask.CREATE
+
+
+class ConfigReloader:
+    """Applies changes of the configuration file without restart.
+
+    Services sections of the new file are compared with the running
+    ones, only services which section was added, removed or changed
+    are stopped or started. Other sections need restart."""
+
+    def __init__(self, config_path: str, config: Config, workstations: Workstations):
+        self.config_path = os.path.abspath(config_path)
+        self.settings = self.global_settings(config)
+        self.workstations = workstations
+
+    @staticmethod
+    def global_settings(config: Config) -> List[Dict[str, Any]]:
+        """Everything except services, workstations are added or removed
+        only on restart."""
+        settings = config.dict(exclude={"services", "workstations"})
+        workstations = [
+            w.dict(exclude={"services"}) for w in config.workstation_configs()
+        ]
+        return [settings, workstations]
+
+    async def watch(self) -> None:
+        # Directory is watched, file itself is replaced by most editors
+        directory, name = os.path.split(self.config_path)
+        with Inotify() as inotify:
+            inotify.add_watch(directory, WATCH_MASK)
+            while True:
+                event = await inotify.get()
+                if event.name is None or str(event.name) != name:
+                    continue
+                loop = asyncio.get_running_loop()
+                deadline = loop.time() + SETTLE_TIME
+                while loop.time() < deadline:
+                    try:
+                        await asyncio.wait_for(inotify.get(), deadline - loop.time())
+                    except asyncio.TimeoutError:
+                        break
+                await self.reload()
+
+    async def reload(self) -> None:
+        try:
+            config = load_config(self.config_path)
+        except Exception as error:
+            LOG.error(f"Configuration is not reloaded: {error}")
+            return
+        if self.global_settings(config) != self.settings:
+            LOG.warning("Only services are reloaded, restart to apply other changes")
+        configs = {w.workstation_name: w for w in config.workstation_configs()}
+        for workstation in self.workstations:
+            name = workstation.config.workstation_name
+            if name in configs:
+                sections = dict(configs[name].services.enabled())
+                await self.reload_workstation(workstation, sections)
+
+    async def reload_workstation(
+        self, workstation: Workstation, sections: Dict[str, Dict[str, Any]]
+    ) -> None:
+        current = workstation.sections
+        stopped = [n for n in current if sections.get(n) != current[n]]
+        started = [n for n in sections if current.get(n) != sections[n]]
+        try:
+            services = create_services((n, sections[n]) for n in started)
+        except Exception as error:
+            LOG.error(f"Configuration is not reloaded: {error}")
+            return
+        removed = [workstation.services.pop(name) for name in stopped]
+        workstation.services.update(zip(started, services))
+        workstation.sections = sections
+        await workstation.manager.replace_services(removed, services)
+        LOG.info(
+            f"Configuration of {workstation.config.workstation_name} reloaded, "
+            f"services stopped: {stopped or 'none'}, started: {started or 'none'}"
+        )
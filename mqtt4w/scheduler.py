@@ -0,0 +1,118 @@
+import asyncio
+import heapq
+import logging
+import math
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set
+
+from mqtt4w.metrics import REGISTRY
+from mqtt4w.services.common.probes import Probe
+
+LOG = logging.getLogger(__name__)
+
+# Due times are rounded up to this step, so probes sharing an interval
+# (or close to each other) are polled on one wake-up
+TIMER_RESOLUTION = 0.5
+
+POLLS = REGISTRY.counter("mqtt4w_probe_polls_total", "Probe polls", ["probe"])
+WAKEUPS = REGISTRY.counter("mqtt4w_scheduler_wakeups_total", "Scheduler wake-ups")
+
+
+class Scheduler:
+    """Polls probes of all services from a single timer.
+
+    Probes are put into slots keyed by their due time rounded to
+    resolution, each wake-up polls the whole slot concurrently.
+    Blocking reads share one bounded executor."""
+
+    def __init__(self, threads: int, resolution: float = TIMER_RESOLUTION):
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="probe"
+        )
+        self.resolution = resolution
+        self.probes: Set[Probe] = set()
+        self.slots: Dict[float, List[Probe]] = {}
+        self.due_times: List[float] = []
+        self.probe_slots: Dict[Probe, float] = {}
+        self.triggered: Dict[Probe, None] = {}
+        self.wakeup: Optional[asyncio.Event] = None
+
+    def __bool__(self) -> bool:
+        return bool(self.probes)
+
+    def add(self, probe: Probe) -> None:
+        probe.wake = self.trigger
+        self.probes.add(probe)
+        if self.wakeup:
+            self.trigger(probe)
+
+    def remove(self, probe: Probe) -> None:
+        probe.wake = None
+        self.probes.discard(probe)
+        self.triggered.pop(probe, None)
+        slot = self.probe_slots.pop(probe, None)
+        if slot is not None:
+            self.slots[slot].remove(probe)
+
+    def schedule(self, probe: Probe, due: float) -> None:
+        slot = math.ceil(due / self.resolution) * self.resolution
+        if slot not in self.slots:
+            self.slots[slot] = []
+            heapq.heappush(self.due_times, slot)
+        self.slots[slot].append(probe)
+        self.probe_slots[probe] = slot
+
+    def trigger(self, probe: Probe) -> None:
+        slot = self.probe_slots.pop(probe, None)
+        if slot is not None:
+            self.slots[slot].remove(probe)
+        self.triggered[probe] = None
+        if self.wakeup:
+            self.wakeup.set()
+
+    def pop_due(self, now: float) -> List[Probe]:
+        due = list(self.triggered)
+        self.triggered.clear()
+        while self.due_times and self.due_times[0] <= now:
+            due.extend(self.slots.pop(heapq.heappop(self.due_times)))
+        for probe in due:
+            self.probe_slots.pop(probe, None)
+        return due
+
+    async def poll(self, probe: Probe) -> None:
+        POLLS.inc(probe.name)
+        try:
+            if probe.blocking:
+                loop = asyncio.get_running_loop()
+                value = await loop.run_in_executor(self.executor, probe.read)
+            else:
+                value = await probe.read()
+        except Exception:
+            LOG.exception(f"Probe {probe.name} failed")
+            return
+        probe.update(value)
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.triggered.update(dict.fromkeys(self.probes))
+        while True:
+            self.wakeup.clear()
+            due = self.pop_due(loop.time())
+            if not due:
+                timer = None
+                if self.due_times:
+                    timer = loop.call_at(self.due_times[0], self.wakeup.set)
+                try:
+                    await self.wakeup.wait()
+                finally:
+                    if timer:
+                        timer.cancel()
+                continue
+            WAKEUPS.inc()
+            await asyncio.gather(*(self.poll(probe) for probe in due))
+            now = loop.time()
+            for probe in due:
+                # Probe could be triggered or removed while polled
+                if probe in self.probes and probe not in self.triggered:
+                    self.schedule(probe, now + probe.current_interval)
@@ -1,10 +1,21 @@
 import logging
 import pathlib
 from enum import Enum
-from typing import AsyncGenerator, Callable, List, NamedTuple, Union
+from typing import (
+    AsyncGenerator,
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
 
 from mqtt4w.services.common.discovery import DiscoveryEntity
+from mqtt4w.services.common.probes import Probe
 from mqtt4w.services.common.structures import Message, Receiver
+from mqtt4w.services.common.topics import Topic
 
 LOG = logging.getLogger(__name__)
 
@@ -15,6 +26,14 @@ class BaseService:
         self.__receivers: List[Receiver] = []
         self.__discoveries: List[DiscoveryEntity] = []
         self.__initializers: List[Callable] = []
+        self.__finalizers: List[Callable] = []
+        self.__probes: List[Probe] = []
+        self.__x_clients: List[Tuple[Optional[str], Callable]] = []
+        self.__topics: Dict[str, Topic] = {}
+        self.debounce: float = 0
+        self.sensor_debounce: Dict[str, float] = {}
+        self.retain = False
+        self.sensor_retain: Dict[str, bool] = {}
 
     @property
     def discoveries(self):
@@ -32,11 +51,36 @@ class BaseService:
     def initializers(self):
         return self.__initializers
 
+    @property
+    def finalizers(self):
+        return self.__finalizers
+
+    @property
+    def probes(self):
+        return self.__probes
+
+    @property
+    def x_clients(self):
+        return self.__x_clients
+
+    @property
+    def topics(self):
+        return self.__topics.values()
+
+    def topic(self, *levels, sensor: Optional[str] = None) -> Topic:
+        relative = "/".join(str(level) for level in levels)
+        if relative not in self.__topics:
+            self.__topics[relative] = Topic(relative, sensor)
+        return self.__topics[relative]
+
+    def state_topic(self, sensor: str) -> Topic:
+        return self.topic(self.subtopic, sensor, "state", sensor=sensor)
+
     def register_receiver(self, subtopic: Union[str, pathlib.Path], receiver_fn):
         self.__receivers.append(Receiver(str(subtopic), receiver_fn, True))
 
     def register_synchronous_receiver(self, subtopic, receiver_fn):
-        LOG.warning(f"Registered synchronous receiver {receiver_fn.__name__}.")
+        """Blocking receiver_fn, run in manager's receivers executor."""
         self.__receivers.append(Receiver(str(subtopic), receiver_fn, False))
 
     def register_sender_gen(self, sender_fn):
@@ -45,5 +89,52 @@ class BaseService:
     def register_initializer(self, initialize_fn):
         self.__initializers.append(initialize_fn)
 
+    def register_finalizer(self, finalize_fn):
+        """Called when the service is stopped, e.g. removed on config reload."""
+        self.__finalizers.append(finalize_fn)
+
+    def register_probe(self, probe: Probe) -> Probe:
+        self.__probes.append(probe)
+        return probe
+
+    def register_x_client(self, display: Optional[str], attach_fn):
+        """Use manager's shared connection to display, None stands for
+        workstation's display or $DISPLAY.
+
+        attach_fn gets XClient once connected and again after reconnect."""
+        self.__x_clients.append((display, attach_fn))
+
+    def set_debounce(self, debounce: float, sensor_debounce: Dict[str, float]):
+        self.debounce = debounce
+        self.sensor_debounce = sensor_debounce
+
+    @property
+    def debounced(self) -> bool:
+        return bool(self.debounce or self.sensor_debounce)
+
+    def settle_time(self, topic: Union[Topic, str, pathlib.Path]) -> float:
+        """Debounce window for a topic, sensor name is its first level."""
+        if self.sensor_debounce:
+            if isinstance(topic, Topic):
+                if topic.sensor is None:
+                    return self.debounce
+                return self.sensor_debounce.get(topic.sensor, self.debounce)
+            try:
+                sensor = pathlib.Path(topic).relative_to(self.subtopic).parts[0]
+            except (AttributeError, ValueError, IndexError):
+                pass
+            else:
+                return self.sensor_debounce.get(sensor, self.debounce)
+        return self.debounce
+
+    def set_retain(self, retain: bool, sensor_retain: Dict[str, bool]):
+        self.retain = retain
+        self.sensor_retain = sensor_retain
+
+    def retains(self, topic: Topic) -> bool:
+        if topic.sensor is None:
+            return self.retain
+        return self.sensor_retain.get(topic.sensor, self.retain)
+
     def register_discoverable(self, entity_type, entity_id, subconfig):
         self.__discoveries.append(DiscoveryEntity(entity_type, entity_id, subconfig))
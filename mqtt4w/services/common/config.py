@@ -1,18 +1,44 @@
-from typing import Callable, Optional
+from typing import Callable, Dict, Optional
 
 from mqtt4w.services.common.baseservice import BaseService
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, NonNegativeFloat
 
 
 class ServiceConfigError(Exception):
     pass
 
 
+class SensorOptionsModel(BaseModel):
+    debounce: Optional[NonNegativeFloat] = None
+    retain: Optional[bool] = None
+
+
 class ServiceBaseModel(BaseModel):
     _constructor: Optional[Callable] = None
 
+    debounce: NonNegativeFloat = 0
+    retain: bool = False
+    sensor_options: Dict[str, SensorOptionsModel] = Field(default_factory=dict)
+
     def create_instance(self, *args) -> BaseService:
         if self._constructor:
-            return self._constructor(*args, **self.dict())
+            common_fields = set(ServiceBaseModel.__fields__)
+            service = self._constructor(*args, **self.dict(exclude=common_fields))
+            self.configure_instance(service)
+            return service
         else:
             raise ServiceConfigError
+
+    def configure_instance(self, service: BaseService) -> None:
+        sensor_debounce = {
+            name: options.debounce
+            for name, options in self.sensor_options.items()
+            if options.debounce is not None
+        }
+        service.set_debounce(self.debounce, sensor_debounce)
+        sensor_retain = {
+            name: options.retain
+            for name, options in self.sensor_options.items()
+            if options.retain is not None
+        }
+        service.set_retain(self.retain, sensor_retain)
@@ -2,3 +2,8 @@ ONLINE = "ONLINE"
 OFFLINE = "OFFLINE"
 ON = "ON"
 OFF = "OFF"
+ON_PAYLOAD = ON.encode()
+OFF_PAYLOAD = OFF.encode()
+# Payload of a binary sensor indexed by its state
+BINARY_PAYLOADS = (OFF_PAYLOAD, ON_PAYLOAD)
+HA_ONLINE = "online"
@@ -1,9 +1,10 @@
+import hashlib
 import json
 import pathlib
 import uuid
 from dataclasses import dataclass
 from enum import Enum, auto
-from typing import Any, Dict
+from typing import Any, Dict, Sequence
 
 from mqtt4w import VERSION
 from mqtt4w.services.common.constants import OFF, OFFLINE, ON, ONLINE
@@ -25,9 +26,10 @@ SUBTOPIC_TEMPLATE = "{type}/{id}/config"
 class EntityType(Enum):
     BUTTON = "button"
     BINARY_SENSOR = "binary_sensor"
+    SENSOR = "sensor"
 
 
-@dataclass
+@dataclass(frozen=True)
 class DiscoveryEntity:
     type: EntityType
     id: str
@@ -46,8 +48,22 @@ def generate_device_cfg(name, id):
     }
 
 
-def generate_availability_config(availability_topic):
-    return {"availability_topic": str(availability_topic), **AVAILABILITY_PAYLOAD}
+def generate_availability_config(availability_topics: Sequence[pathlib.Path]):
+    if len(availability_topics) == 1:
+        return {
+            "availability_topic": str(availability_topics[0]),
+            **AVAILABILITY_PAYLOAD,
+        }
+    # Entity is available only while all the topics are online
+    availability = [
+        {
+            "topic": str(topic),
+            "payload_available": ONLINE,
+            "payload_not_available": OFFLINE,
+        }
+        for topic in availability_topics
+    ]
+    return {"availability": availability, "availability_mode": "all"}
 
 
 def generate_subconfig(
@@ -58,6 +74,9 @@ def generate_subconfig(
     payload_on=None,
     payload_off=None,
     payload_press=None,
+    unit_of_measurement=None,
+    json_attributes_topic=None,
+    entity_category=None,
 ):
     subconfig = {"name": name}
     if icon:
@@ -72,6 +91,12 @@ def generate_subconfig(
         subconfig["payload_off"] = payload_off
     if payload_press:
         subconfig["payload_press"] = payload_press
+    if unit_of_measurement:
+        subconfig["unit_of_measurement"] = unit_of_measurement
+    if json_attributes_topic:
+        subconfig["json_attributes_topic"] = json_attributes_topic
+    if entity_category:
+        subconfig["entity_category"] = entity_category
     return subconfig
 
 
@@ -88,10 +113,10 @@ def expand_discovery_entity(
     uniq_id,
     base_topic: pathlib.Path,
     workstation_name: str,
-    availability_topic: pathlib.Path,
+    availability_topics: Sequence[pathlib.Path],
 ) -> Message:
-    subconfig = entity.subconfig
-    topic_keys = ["command_topic", "state_topic"]
+    subconfig = dict(entity.subconfig)
+    topic_keys = ["command_topic", "state_topic", "json_attributes_topic"]
     for k in topic_keys:
         if k in subconfig:
             subconfig[k] = str(base_topic / subconfig[k])
@@ -100,7 +125,11 @@ def expand_discovery_entity(
         "uniq_id": expanded_id,
         **subconfig,
         **generate_device_cfg(workstation_name, uniq_id),
-        **generate_availability_config(availability_topic),
+        **generate_availability_config(availability_topics),
     }
     topic = SUBTOPIC_TEMPLATE.format(type=entity.type.value, id=expanded_id)
     return Message(topic, json.dumps(config), discovery=True)
+
+
+def payload_digest(payload: bytes) -> str:
+    return hashlib.sha256(payload).hexdigest()
@@ -0,0 +1,130 @@
+import fnmatch
+import re
+from collections import deque
+from enum import Enum
+from typing import Dict, Iterable, List, Optional, Pattern, Set, Tuple
+
+GLOB_MAGIC = re.compile(r"[*?[]")
+
+
+class RuleKind(str, Enum):
+    EQUALS = "equals"
+    CONTAINS = "contains"
+    GLOB = "glob"
+    REGEX = "regex"
+
+
+class LiteralAutomaton:
+    """Aho-Corasick automaton for substring rules.
+
+    Finds every literal contained in the text in a single pass over it,
+    no matter how many literals there are."""
+
+    def __init__(self, literals: Dict[str, List[int]]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.outputs: List[Tuple[int, ...]] = [()]
+        for literal, values in literals.items():
+            state = 0
+            for char in literal:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.outputs.append(())
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.outputs[state] += tuple(values)
+        self.fail = [0] * len(self.goto)
+        # Breadth first, so fail links of shorter prefixes are ready
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(char, 0)
+                self.fail[child] = target if target != child else 0
+                self.outputs[child] += self.outputs[self.fail[child]]
+
+    def __bool__(self) -> bool:
+        return len(self.goto) > 1
+
+    def search(self, text: str) -> Set[int]:
+        found: Set[int] = set()
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if outputs[state]:
+                found.update(outputs[state])
+        return found
+
+
+def rule_regex(kind: RuleKind, pattern: str) -> str:
+    """Regex matching the rule from the start of the text."""
+    if kind == RuleKind.EQUALS:
+        return re.escape(pattern) + r"\Z"
+    if kind == RuleKind.CONTAINS:
+        return r"(?s:.*?)" + re.escape(pattern)
+    if kind == RuleKind.GLOB:
+        return fnmatch.translate(pattern)
+    re.compile(pattern)
+    return rf"(?s:.*?)(?:{pattern})"
+
+
+class RulesMatcher:
+    """Matches text against all rules at once.
+
+    Exact rules are a dict lookup, case sensitive substrings go through
+    one Aho-Corasick automaton, and the rest are compiled into a single
+    regex of lookaheads, one per rule, each setting a marker group when
+    its rule matches."""
+
+    def __init__(self, rules: Iterable[Tuple[RuleKind, str, bool, int]]):
+        self.exact: Dict[str, List[int]] = {}
+        literals: Dict[str, List[int]] = {}
+        lookaheads: List[str] = []
+        self.groups: Dict[str, int] = {}
+        for kind, pattern, ignore_case, value in rules:
+            if kind == RuleKind.GLOB and not GLOB_MAGIC.search(pattern):
+                # No wildcards, glob is an exact title
+                kind = RuleKind.EQUALS
+            if kind == RuleKind.EQUALS and not ignore_case:
+                self.exact.setdefault(pattern, []).append(value)
+            elif kind == RuleKind.CONTAINS and not ignore_case:
+                literals.setdefault(pattern, []).append(value)
+            else:
+                regex = rule_regex(kind, pattern)
+                if ignore_case:
+                    regex = f"(?i:{regex})"
+                group = f"_rule{len(lookaheads)}"
+                self.groups[group] = value
+                lookaheads.append(f"(?:(?={regex})(?P<{group}>))?")
+        self.literals = LiteralAutomaton(literals)
+        self.regex: Optional[Pattern] = None
+        if lookaheads:
+            try:
+                self.regex = re.compile("".join(lookaheads))
+            except re.error as error:
+                # Each regex compiled alone, so only the combination fails
+                raise ValueError(
+                    "Regex rules can't use global flags or numbered "
+                    f"backreferences, use ignore_case instead: {error}"
+                )
+
+    def match(self, text: str) -> Tuple[int, ...]:
+        """Values of all matching rules, each value once."""
+        found = set(self.exact.get(text, ()))
+        if self.literals:
+            found.update(self.literals.search(text))
+        if self.regex:
+            match = self.regex.match(text)
+            # Patterns may have named groups too, only markers are checked
+            found.update(
+                value
+                for group, value in self.groups.items()
+                if match.group(group) is not None
+            )
+        return tuple(sorted(found))
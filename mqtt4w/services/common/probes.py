@@ -0,0 +1,59 @@
+import asyncio
+from typing import Any, Callable, Iterable, Optional
+
+from .structures import Message
+
+NOT_READ = object()
+
+
+class Probe:
+    """Value polled by the manager's scheduler.
+
+    Right after a change the value is polled every `interval` seconds,
+    while it stays the same the interval grows `backoff` times per poll
+    up to `max_interval`. `read` may be a coroutine function, plain
+    functions are run in the scheduler's executor. `messages` gets the
+    previous (None at first poll) and the new value of a changed probe."""
+
+    def __init__(
+        self,
+        read: Callable[[], Any],
+        messages: Callable[[Any, Any], Iterable[Message]],
+        interval: float,
+        max_interval: Optional[float] = None,
+        backoff: float = 2,
+        name: Optional[str] = None,
+    ):
+        self.read = read
+        self.messages = messages
+        self.interval = interval
+        self.max_interval = max(max_interval or interval, interval)
+        self.backoff = backoff
+        self.name = name or read.__qualname__
+        self.blocking = not asyncio.iscoroutinefunction(read)
+        self.current_interval = interval
+        self.value: Any = NOT_READ
+        self.wake: Optional[Callable[["Probe"], None]] = None
+        self.outgoing: asyncio.Queue = asyncio.Queue()
+
+    def trigger(self) -> None:
+        """Poll as soon as possible, e.g. when an event source hints a change."""
+        if self.wake:
+            self.wake(self)
+
+    def update(self, value: Any) -> bool:
+        if value == self.value:
+            self.current_interval = min(
+                self.current_interval * self.backoff, self.max_interval
+            )
+            return False
+        previous = None if self.value is NOT_READ else self.value
+        self.value = value
+        self.current_interval = self.interval
+        for message in self.messages(previous, value):
+            self.outgoing.put_nowait(message)
+        return True
+
+    async def produce(self):
+        while True:
+            yield await self.outgoing.get()
@@ -0,0 +1,53 @@
+import os
+from collections import Counter
+from itertools import chain
+from typing import Dict, Iterable, List, Optional
+
+PROC = "/proc"
+
+
+def procfs_available() -> bool:
+    return os.access(os.path.join(PROC, "self", "fd"), os.R_OK)
+
+
+def scan_open_files(
+    paths: Iterable[str], pids: Optional[Iterable[int]] = None
+) -> Dict[str, Counter]:
+    """Count descriptors of any of the paths opened by each process.
+
+    Walks /proc/<pid>/fd once for all paths, processes which fds
+    can't be read (other users' ones without privileges) are skipped.
+    With pids given only these processes are checked."""
+    wanted: Dict[str, List[str]] = {}
+    for path in paths:
+        wanted.setdefault(os.path.realpath(path), []).append(path)
+    holders: Dict[str, Counter] = {p: Counter() for p in chain(*wanted.values())}
+    if pids is None:
+        with os.scandir(PROC) as processes:
+            pids = [int(p.name) for p in processes if p.name.isdigit()]
+    for pid in pids:
+        try:
+            fds = os.scandir(os.path.join(PROC, str(pid), "fd"))
+        except OSError:
+            continue
+        with fds:
+            for fd in fds:
+                try:
+                    target = os.readlink(fd.path)
+                except OSError:
+                    continue
+                for path in wanted.get(target, ()):
+                    holders[path][pid] += 1
+    return holders
+
+
+def process_name(pid: int) -> Optional[str]:
+    try:
+        with open(os.path.join(PROC, str(pid), "comm")) as comm:
+            return comm.read().rstrip("\n")
+    except OSError:
+        return None
+
+
+def process_names(pids: Iterable[int]) -> Dict[int, Optional[str]]:
+    return {pid: process_name(pid) for pid in pids}
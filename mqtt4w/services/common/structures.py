@@ -1,12 +1,16 @@
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Callable, Optional, Union
+from typing import Any, Callable, NamedTuple, Optional, Union
 
+from .topics import Topic
 
-@dataclass
-class Message:
-    topic: Union[Path, str]
-    payload: str
+
+class Message(NamedTuple):
+    """Immutable and slotted, created for every state change."""
+
+    topic: Union[Topic, Path, str]
+    # Constant payloads are better passed pre-encoded, see constants
+    payload: Union[str, bytes]
     discovery: bool = False
 
 
@@ -0,0 +1,113 @@
+import re
+from typing import Any, Dict, List, Optional, Union
+
+INVALID_LEVEL_CHARS = re.compile(r"[\s/+#]+")
+
+
+def normalize_level(name: str) -> str:
+    """Make string safe to be used as a single topic level."""
+    return INVALID_LEVEL_CHARS.sub("_", name.strip()) or "_"
+
+
+class Topic:
+    """Handle of a topic relative to the workstation base topic.
+
+    Fully qualified topic string is computed once, when the handle is
+    registered in TopicRegistry, and reused for every message."""
+
+    __slots__ = ("relative", "sensor", "full", "retain")
+
+    def __init__(self, relative: str, sensor: Optional[str] = None):
+        self.relative = relative
+        self.sensor = sensor
+        self.full: Optional[str] = None
+        self.retain = False
+
+    def __str__(self) -> str:
+        return self.full or self.relative
+
+    def __repr__(self) -> str:
+        return f"Topic({self.relative!r})"
+
+
+class TopicRegistry:
+    def __init__(self, base_topic: str):
+        self.base_topic = base_topic
+        self.topics: Dict[str, Topic] = {}
+
+    def register(self, topic: Topic) -> Topic:
+        topic.full = f"{self.base_topic}/{topic.relative}"
+        self.topics[topic.full] = topic
+        return topic
+
+    def unregister(self, topic: Topic) -> None:
+        if topic.full is not None:
+            self.topics.pop(topic.full, None)
+
+    def resolve(self, topic: Union[Topic, str]) -> str:
+        if isinstance(topic, Topic):
+            return topic.full or self.register(topic).full  # type: ignore
+        return f"{self.base_topic}/{topic}"
+
+
+class TopicTrie:
+    """Topic filters (with + and # wildcards) stored level by level.
+
+    Matching a topic visits at most a few nodes per level, so its cost
+    depends on topic depth, not on the number of stored filters."""
+
+    def __init__(self):
+        self.children: Dict[str, "TopicTrie"] = {}
+        self.values: List[Any] = []
+
+    def __bool__(self) -> bool:
+        return bool(self.children or self.values)
+
+    def insert(self, topic_filter: str, value: Any) -> None:
+        node = self
+        for level in topic_filter.split("/"):
+            node = node.children.setdefault(level, TopicTrie())
+        node.values.append(value)
+
+    def remove(self, topic_filter: str, value: Any) -> None:
+        """Remove value stored for the filter, prune nodes left empty."""
+        path = [self]
+        for level in topic_filter.split("/"):
+            node = path[-1].children.get(level)
+            if node is None:
+                return
+            path.append(node)
+        if value in path[-1].values:
+            path[-1].values.remove(value)
+        levels = topic_filter.split("/")
+        for parent, level, node in zip(path[-2::-1], levels[::-1], path[::-1]):
+            if node:
+                break
+            del parent.children[level]
+
+    def match(self, topic: str) -> List[Any]:
+        matched: List[Any] = []
+        nodes = [self]
+        for level in topic.split("/"):
+            next_nodes = []
+            for node in nodes:
+                if "#" in node.children:
+                    matched.extend(node.children["#"].values)
+                for key in (level, "+"):
+                    if key in node.children:
+                        next_nodes.append(node.children[key])
+            nodes = next_nodes
+            if not nodes:
+                return matched
+        for node in nodes:
+            matched.extend(node.values)
+            # "a/#" matches "a" too
+            if "#" in node.children:
+                matched.extend(node.children["#"].values)
+        return matched
+
+    def filters(self, prefix: str = "") -> List[str]:
+        result = [prefix] if self.values else []
+        for level, child in self.children.items():
+            result.extend(child.filters(f"{prefix}/{level}" if prefix else level))
+        return result
@@ -1,8 +1,93 @@
+import asyncio
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterator,
+    Sequence,
+    Union,
+)
+
+from .constants import BINARY_PAYLOADS
 from .structures import Message
+from .topics import Topic
 
 
-async def messages_for_states_generator(states, topic):
+async def messages_for_states_generator(states, state_topic: Callable[[str], Topic]):
     for name, state in states.items():
-        state_topic = topic / name / "state"
-        payload = "ON" if state else "OFF"
-        yield Message(state_topic, payload)
+        yield Message(state_topic(name), BINARY_PAYLOADS[bool(state)])
+
+
+def iter_bits(mask: int) -> Iterator[int]:
+    """Indexes of set bits, lowest first."""
+    while mask:
+        lowest = mask & -mask
+        yield lowest.bit_length() - 1
+        mask ^= lowest
+
+
+def all_bits(count: int) -> int:
+    return (1 << count) - 1
+
+
+def bitset_messages(
+    topics: Sequence[Topic], states: int, changed: int
+) -> Iterator[Message]:
+    """Messages for binary sensors which bits are set in changed.
+
+    Sensor i state is bit i of states, its topic is topics[i]."""
+    for index in iter_bits(changed):
+        yield Message(topics[index], BINARY_PAYLOADS[states >> index & 1])
+
+
+async def debounce_messages(
+    messages: AsyncIterable[Message], settle_time: Callable[[Any], float]
+) -> AsyncIterator[Message]:
+    """Coalesce bursts of messages per topic.
+
+    First message for a topic opens a window of settle_time(topic)
+    seconds, newer messages for the same topic replace the pending one.
+    When the window closes, the last message is yielded unless it
+    repeats the payload already sent to this topic."""
+    loop = asyncio.get_running_loop()
+    pending: Dict[Any, Message] = {}
+    deadlines: Dict[Any, float] = {}
+    sent: Dict[Any, Union[str, bytes]] = {}
+    source = messages.__aiter__()
+    next_message = asyncio.ensure_future(source.__anext__())
+    try:
+        while True:
+            timeout = None
+            if deadlines:
+                timeout = max(min(deadlines.values()) - loop.time(), 0)
+            done, _ = await asyncio.wait({next_message}, timeout=timeout)
+            if done:
+                try:
+                    message = next_message.result()
+                except StopAsyncIteration:
+                    break
+                next_message = asyncio.ensure_future(source.__anext__())
+                topic = message.topic
+                delay = settle_time(topic)
+                if delay > 0:
+                    pending[topic] = message
+                    deadlines.setdefault(topic, loop.time() + delay)
+                else:
+                    pending.pop(topic, None)
+                    deadlines.pop(topic, None)
+                    sent[topic] = message.payload
+                    yield message
+            now = loop.time()
+            for topic in [t for t, d in deadlines.items() if d <= now]:
+                del deadlines[topic]
+                message = pending.pop(topic)
+                if sent.get(topic) != message.payload:
+                    sent[topic] = message.payload
+                    yield message
+        for topic, message in pending.items():
+            if sent.get(topic) != message.payload:
+                yield message
+    finally:
+        next_message.cancel()
@@ -1,31 +1,46 @@
+import abc
 import asyncio
-import ctypes
-import json
+import fnmatch
+import glob
 import logging
-import struct
-from enum import IntEnum
+import os
+import re
+import shutil
+from enum import Enum, IntEnum
+from functools import partial
 from pathlib import Path
-from typing import AsyncGenerator, List
+from typing import Dict, List, Optional
 
+import Xlib.error
+from mqtt4w.metrics import REGISTRY
 from mqtt4w.services.common.baseservice import BaseService
 from mqtt4w.services.common.config import ServiceBaseModel
-from mqtt4w.services.common.constants import OFF, ON
-from mqtt4w.services.common.discovery import (
-    SUBTOPIC_TEMPLATE,
-    DiscoveryEntity,
-    EntityType,
-    generate_availability_config,
-    generate_device_cfg,
-    generate_subconfig,
-)
+from mqtt4w.services.common.constants import BINARY_PAYLOADS, OFF, ON
+from mqtt4w.services.common.discovery import EntityType, generate_subconfig
+from mqtt4w.services.common.probes import Probe
 from mqtt4w.services.common.structures import Message
-from pydantic import PositiveInt
+from mqtt4w.services.common.topics import Topic
+from mqtt4w.xsession import XClient
+from pydantic import PositiveInt, root_validator
+from Xlib.ext import dpms, screensaver
+
+DRM_PATH = "/sys/class/drm"
+# Longest value of drm connector's dpms attribute is "Standby\n"
+DRM_DPMS_SIZE = 16
+# Screensaver notifications report changes, polling only backs them up
+EVENT_DRIVEN_MAX_CHECK_INTERVAL = 20
 
-LIBXEXT_NAME = "libXext.so"
+INVALID_ID_CHARS = re.compile(r"[^A-Za-z0-9_-]+")
 
 
 LOG = logging.getLogger(__name__)
 
+SERVICE_NAME = "dpms"
+X_REQUESTS = REGISTRY.counter(
+    "mqtt4w_x_requests_total", "X requests waiting for reply", ["service"]
+)
+X_EVENTS = REGISTRY.counter("mqtt4w_x_events_total", "Handled X events", ["service"])
+
 
 class DPMS(IntEnum):
     NONE = -2
@@ -36,74 +51,339 @@ class DPMS(IntEnum):
     OFF = 3
 
 
+class Backend(str, Enum):
+    X = "x"
+    SYSFS = "sysfs"
+    LOGIND = "logind"
+
+
+def output_id(output: str) -> str:
+    """Make output name usable as topic level and discovery object id."""
+    return INVALID_ID_CHARS.sub("_", output).strip("_") or "display"
+
+
+class DPMSBackend(abc.ABC):
+    """Source of power states for a set of outputs.
+
+    Backends with can_turn_off set also provide turn_off(output)."""
+
+    can_turn_off = False
+    events = False
+
+    def __init__(self, outputs: List[str]):
+        self.outputs = outputs
+
+    @abc.abstractmethod
+    def read_states(self) -> Dict[str, bool]:
+        """Read all outputs at once, True means the output is on.
+
+        May be a coroutine function, plain ones are run in executor."""
+
+    async def wait_for_event(self, timeout: float) -> bool:
+        """Wait for a hint that states may have changed."""
+        await asyncio.sleep(timeout)
+        return False
+
+    def close(self) -> None:
+        pass
+
+
+class XBackend(DPMSBackend):
+    """DPMS extension of X displays, one output per display.
+
+    Displays are reached through manager's shared X sessions, with
+    event_driven set screensaver notifications trigger reads. Output
+    None is the workstation's display (or $DISPLAY)."""
+
+    can_turn_off = True
+
+    def __init__(self, outputs: List[Optional[str]], event_driven: bool):
+        super().__init__(outputs)
+        self.events = event_driven
+        self.clients: Dict[Optional[str], XClient] = {}
+        self.dpms_capable: Dict[Optional[str], bool] = {}
+        self.changed = asyncio.Event()
+
+    def attach(self, output: Optional[str], client: XClient) -> None:
+        display = client.display
+        self.clients[output] = client
+        capable = display.has_extension(dpms.extname)
+        self.dpms_capable[output] = capable and display.dpms_capable().capable
+        if not self.dpms_capable[output]:
+            LOG.warning(f"Display {client.session.name} is not DPMS capable")
+        if self.events:
+            notify = client.extension_event(screensaver.extname)
+            if notify is None:
+                LOG.warning(
+                    f"No screensaver events on {client.session.name}, polling DPMS"
+                )
+            else:
+                display.screen().root.screensaver_select_input(
+                    screensaver.NotifyMask | screensaver.CycleMask
+                )
+                client.subscribe(self.notify, notify)
+        # Connection is new, state could change while it was lost
+        self.changed.set()
+
+    def notify(self, events: list) -> None:
+        X_EVENTS.inc(SERVICE_NAME, amount=len(events))
+        self.changed.set()
+
+    def capable_display(self, output: Optional[str]):
+        client = self.clients.get(output)
+        if client is None or not self.dpms_capable.get(output):
+            return None
+        return client.display
+
+    def is_on(self, output: Optional[str]) -> bool:
+        display = self.capable_display(output)
+        if display is None:
+            return False
+        X_REQUESTS.inc(SERVICE_NAME)
+        try:
+            info = display.dpms_info()
+        except Xlib.error.ConnectionClosedError:  # type: ignore
+            return False
+        return not info.state or info.power_level == DPMS.ON
+
+    def read_states(self) -> Dict[Optional[str], bool]:
+        return {output: self.is_on(output) for output in self.outputs}
+
+    def turn_off(self, output: Optional[str]) -> None:
+        display = self.capable_display(output)
+        if display is None:
+            LOG.warning(f"Can't turn off display {output or 'default'}, no DPMS")
+            return
+        if not display.dpms_info().state:
+            # Forcing level with DPMS disabled is a BadMatch error
+            display.dpms_enable()
+        display.dpms_force_level(DPMS.OFF)
+        display.flush()
+
+    async def wait_for_event(self, timeout: float) -> bool:
+        """Sleep until any display reports something or timeout passes."""
+        changed = asyncio.ensure_future(self.changed.wait())
+        try:
+            done, _ = await asyncio.wait({changed}, timeout=timeout)
+        finally:
+            changed.cancel()
+        self.changed.clear()
+        return bool(done)
+
+
+class SysfsBackend(DPMSBackend):
+    """Kernel's view of DRM connectors, works under any display server.
+
+    Attribute files are kept open and re-read with pread, so a check
+    is a single syscall per output."""
+
+    def __init__(self, outputs: List[str]):
+        connectors = sorted(
+            os.path.basename(os.path.dirname(path))
+            for path in glob.glob(os.path.join(DRM_PATH, "*", "dpms"))
+        )
+        if outputs:
+            selected = [
+                connector
+                for connector in connectors
+                if any(fnmatch.fnmatchcase(connector, output) for output in outputs)
+            ]
+            # Patterns without matches yet are kept as outputs which are off
+            selected += [
+                output
+                for output in outputs
+                if not glob.has_magic(output) and output not in selected
+            ]
+        else:
+            selected = [c for c in connectors if self.connected(c)]
+        if not selected:
+            LOG.warning(f"No DRM connectors found in {DRM_PATH}")
+        super().__init__(selected)
+        self.fds: Dict[str, int] = {}
+
+    @staticmethod
+    def connected(connector: str) -> bool:
+        try:
+            with open(os.path.join(DRM_PATH, connector, "status")) as status:
+                return status.read().strip() == "connected"
+        except OSError:
+            return False
+
+    def read_dpms(self, output: str) -> Optional[bytes]:
+        fd = self.fds.get(output)
+        try:
+            if fd is None:
+                fd = os.open(os.path.join(DRM_PATH, output, "dpms"), os.O_RDONLY)
+                self.fds[output] = fd
+            return os.pread(fd, DRM_DPMS_SIZE, 0)
+        except OSError:
+            # Connector was unplugged (e.g. MST hub), reopen on next check
+            if fd is not None:
+                os.close(self.fds.pop(output))
+            return None
+
+    def close(self) -> None:
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds.clear()
+
+    def read_states(self) -> Dict[str, bool]:
+        return {output: self.read_dpms(output) == b"On\n" for output in self.outputs}
+
+
+class LogindBackend(DPMSBackend):
+    """Idle hints of logind sessions, set by the compositor or screen locker.
+
+    All sessions are read by one loginctl call per check."""
+
+    def __init__(self, outputs: List[str]):
+        super().__init__(outputs or ["self"])
+        self.loginctl = shutil.which("loginctl")
+        if not self.loginctl:
+            LOG.error("Please install systemd's loginctl to use logind backend!")
+
+    async def read_states(self) -> Dict[str, bool]:
+        states = dict.fromkeys(self.outputs, False)
+        if not self.loginctl:
+            return states
+        process = await asyncio.create_subprocess_exec(
+            self.loginctl,
+            "show-session",
+            "--property=IdleHint",
+            *self.outputs,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await process.communicate()
+        hints = [
+            line.partition("=")[2]
+            for line in stdout.decode().splitlines()
+            if line.startswith("IdleHint=")
+        ]
+        if process.returncode or len(hints) != len(self.outputs):
+            LOG.warning(f"Can't read idle hints: {stderr.decode().strip()}")
+            return states
+        for output, hint in zip(self.outputs, hints):
+            states[output] = hint == "no"
+        return states
+
+
 class DPMSService(BaseService):
-    def __init__(self, subtopic, display, check_interval):
+    def __init__(
+        self,
+        subtopic,
+        backend,
+        display,
+        outputs,
+        check_interval,
+        max_check_interval,
+        event_driven,
+    ):
         super().__init__()
-        self.incoming_msg = asyncio.Queue()
-        self.outgoing_msg = asyncio.Queue()
         self.subtopic = subtopic
-        self.state_topic = subtopic / "state"
-        self.display = display
-        self.libXext = self.get_libxext()
         self.check_interval = check_interval
-        self.register_sender_gen(self.display_states)
-        self.register_discoverables()
+        self.max_check_interval = max_check_interval
+        if backend == Backend.X:
+            self.backend = XBackend(outputs or [display], event_driven)
+            for output in self.backend.outputs:
+                self.register_x_client(output, partial(self.backend.attach, output))
+        elif backend == Backend.SYSFS:
+            self.backend = SysfsBackend(outputs)
+        else:
+            self.backend = LogindBackend(outputs)
+        self.state_topics: Dict[str, Topic] = {}
+        self.turn_off_topics: Dict[str, Topic] = {}
+        for output in self.backend.outputs:
+            self.register_output(output)
+        self.probe = self.register_probe(
+            Probe(
+                self.backend.read_states,
+                self.state_messages,
+                check_interval,
+                max_check_interval,
+                name=SERVICE_NAME,
+            )
+        )
+        if self.backend.events:
+            self.register_initializer(self.watch_events)
+        self.register_finalizer(self.backend.close)
 
-    def register_discoverables(self):
-        dpms_id = "dpms_state"
+    def register_output(self, output: str):
+        if len(self.backend.outputs) == 1:
+            # Single output keeps topics of the single display service
+            state_topic = self.topic(self.subtopic, "state")
+            turn_off_topic = self.topic(self.subtopic, "turn_off")
+            entity_id, suffix = "dpms", ""
+        else:
+            sensor = output_id(output)
+            state_topic = self.state_topic(sensor)
+            turn_off_topic = self.topic(
+                self.subtopic, sensor, "turn_off", sensor=sensor
+            )
+            entity_id, suffix = f"dpms_{sensor}", f" {output}"
+        self.state_topics[output] = state_topic
         subconfig = generate_subconfig(
-            "DPMS state",
-            state_topic=str(self.state_topic),
+            f"DPMS state{suffix}",
+            state_topic=state_topic.relative,
             payload_on=ON,
             payload_off=OFF,
         )
-        self.register_discoverable(EntityType.BINARY_SENSOR, dpms_id, subconfig)
+        self.register_discoverable(
+            EntityType.BINARY_SENSOR, f"{entity_id}_state", subconfig
+        )
+        if not self.backend.can_turn_off:
+            return
+        self.turn_off_topics[output] = turn_off_topic
+        self.register_synchronous_receiver(
+            turn_off_topic.relative, partial(self.turn_off, output)
+        )
+        subconfig = generate_subconfig(
+            f"Turn off display{suffix}",
+            icon="mdi:monitor-off",
+            command_topic=turn_off_topic.relative,
+        )
+        self.register_discoverable(
+            EntityType.BUTTON, f"{entity_id}_turn_off", subconfig
+        )
 
-    def get_libxext(self):
-        try:
-            ctypes.cdll.LoadLibrary(LIBXEXT_NAME)
-            return ctypes.CDLL(LIBXEXT_NAME)
-        except OSError:
-            LOG.error("Please install libXext package!")
-
-    def dpms_state(self):
-        state = 1
-        display = self.display.encode("ascii")
-        display_name = ctypes.c_char_p()
-        display_name.value = display
-        self.libXext.XOpenDisplay.restype = ctypes.c_void_p  # type: ignore
-        display = ctypes.c_void_p(self.libXext.XOpenDisplay(display_name))  # type: ignore
-        dummy1_i_p = ctypes.create_string_buffer(8)
-        dummy2_i_p = ctypes.create_string_buffer(8)
-        if display.value:
-            if self.libXext.DPMSQueryExtension(  # type: ignore
-                display, dummy1_i_p, dummy2_i_p
-            ) and self.libXext.DPMSCapable(  # type: ignore
-                display
-            ):
-                onoff_p = ctypes.create_string_buffer(1)
-                state_p = ctypes.create_string_buffer(2)
-                if self.libXext.DPMSInfo(display, state_p, onoff_p):  # type: ignore
-                    onoff = struct.unpack("B", onoff_p.raw)[0]
-                    if onoff:
-                        state = struct.unpack("H", state_p.raw)[0]
-            self.libXext.XCloseDisplay(display)  # type: ignore
-        return state
-
-    async def display_states(self):
-        state = self.dpms_state()
-        yield Message(self.state_topic, OFF if state else ON)
+    def turn_off(self, output: Optional[str], message: Message):
+        # X round-trips block, so it runs in receivers executor
+        self.backend.turn_off(output)
+
+    def state_messages(self, previous, states):
+        for output, on in states.items():
+            if previous is None or previous[output] != on:
+                yield Message(self.state_topics[output], BINARY_PAYLOADS[on])
+
+    async def watch_events(self):
         while True:
-            new_state = self.dpms_state()
-            if state != new_state:
-                state = new_state
-                yield Message(str(self.state_topic), OFF if state else ON)
-            await asyncio.sleep(self.check_interval)
+            if await self.backend.wait_for_event(self.max_check_interval):
+                self.probe.trigger()
 
 
 class ServiceModel(ServiceBaseModel):
     _constructor = DPMSService
 
     subtopic: Path = Path("dpms")
-    display: str = ":1"
+    backend: Backend = Backend.X
+    # Workstation's display (or $DISPLAY) if not set
+    display: Optional[str] = None
+    # X displays, DRM connectors (globs allowed) or logind sessions
+    outputs: List[str] = []
+    # Polling speeds up to check_interval after a change and slows down
+    # to max_check_interval while displays stay in the same state, so
+    # changes can be reported up to max_check_interval late. Defaults to
+    # check_interval, or to 20 when event_driven reports changes anyway
     check_interval: PositiveInt = 5
+    max_check_interval: Optional[PositiveInt] = None
+    event_driven: bool = False
+
+    @root_validator(skip_on_failure=True)
+    def default_max_check_interval(cls, values):
+        if values["max_check_interval"] is None:
+            values["max_check_interval"] = (
+                EVENT_DRIVEN_MAX_CHECK_INTERVAL
+                if values["event_driven"]
+                else values["check_interval"]
+            )
+        return values
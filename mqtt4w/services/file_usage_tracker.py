@@ -1,16 +1,21 @@
+import asyncio
+import json
+import logging
+import os
+import re
 import shutil
 import subprocess
+import time
+from array import array
 from asyncio import Queue
-from dataclasses import dataclass, field
+from collections import Counter, defaultdict
+from itertools import chain
 from pathlib import Path
-from typing import AsyncGenerator, Dict, List
+from typing import AsyncGenerator, Dict, List, Optional, Pattern, Set, Tuple
 
-from asyncinotify import Inotify, Mask
-from mqtt4w.services.common import (
-    Message,
-    ServiceBaseModel,
-    messages_for_states_generator,
-)
+from asyncinotify import Inotify, Mask, Watch
+from mqtt4w.metrics import REGISTRY
+from mqtt4w.services.common import Message, ServiceBaseModel
 from mqtt4w.services.common.baseservice import BaseService
 from mqtt4w.services.common.constants import OFF, ON
 from mqtt4w.services.common.discovery import (
@@ -18,16 +23,100 @@ from mqtt4w.services.common.discovery import (
     EntityType,
     generate_subconfig,
 )
-from pydantic import Field
+from mqtt4w.services.common.procfs import (
+    process_names,
+    procfs_available,
+    scan_open_files,
+)
+from mqtt4w.services.common.utils import all_bits, bitset_messages
+from pydantic import Field, NonNegativeFloat, NonNegativeInt
+
+LOG = logging.getLogger(__name__)
+
+INOTIFY_EVENTS = REGISTRY.counter("mqtt4w_inotify_events_total", "Inotify events")
+PROC_SCANS = REGISTRY.histogram("mqtt4w_proc_scan_seconds", "Duration of /proc scans")
+
+GLOB_MAGIC = re.compile(r"[*?[]")
+FILE_MASK = Mask.OPEN | Mask.CLOSE
+# Device nodes are created as root 0600, udev grants access afterwards,
+# so watches refused on creation are retried when attributes change
+DIRECTORY_MASK = (
+    Mask.CREATE | Mask.DELETE | Mask.MOVED_TO | Mask.MOVED_FROM | Mask.ATTRIB
+)
+
+
+def glob_to_regex(pattern: str) -> str:
+    """Translate glob pattern of a file name into regex without groups."""
+    regex = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        i += 1
+        if char == "*":
+            regex.append(".*")
+        elif char == "?":
+            regex.append(".")
+        elif char == "[" and "]" in pattern[i + 1 :]:
+            end = pattern.index("]", i + 1)
+            chars = pattern[i:end]
+            i = end + 1
+            if chars[0] == "!":
+                chars = "^" + chars[1:]
+            regex.append(f"[{chars.replace(chr(92), chr(92) * 2)}]")
+        else:
+            regex.append(re.escape(char))
+    return "".join(regex)
+
+
+class FilesIndex:
+    """Maps paths to sensors.
 
+    Exact paths are looked up in a dict, glob patterns (only the file
+    name part may contain wildcards) are compiled into a single regex
+    per directory, so matching a path is one dict lookup and one regex
+    match regardless of patterns count."""
 
-@dataclass
-class Sensor:
-    entities: Dict[str, bool] = field(default_factory=dict)
+    def __init__(self, sensors: Dict[str, List[str]]):
+        self.exact: Dict[str, str] = {}
+        patterns: Dict[str, List[Tuple[str, str]]] = defaultdict(list)
+        for sensor, files in sensors.items():
+            for file in files:
+                directory, name = os.path.split(file)
+                if GLOB_MAGIC.search(directory):
+                    raise ValueError(f"Wildcards allowed only in file names: {file}")
+                if GLOB_MAGIC.search(name):
+                    patterns[directory].append((name, sensor))
+                else:
+                    self.exact[file] = sensor
+        self.patterns: Dict[str, Tuple[Pattern, List[str]]] = {}
+        for directory, items in patterns.items():
+            regex = "|".join(f"({glob_to_regex(name)})" for name, _ in items)
+            sensors_order = [sensor for _, sensor in items]
+            self.patterns[directory] = (re.compile(regex), sensors_order)
 
     @property
-    def enabled(self):
-        return any(self.entities.values())
+    def directories(self) -> Set[str]:
+        return {os.path.dirname(f) for f in self.exact} | set(self.patterns)
+
+    def match(self, path: str) -> Optional[str]:
+        if path in self.exact:
+            return self.exact[path]
+        directory, name = os.path.split(path)
+        if directory not in self.patterns:
+            return None
+        regex, sensors = self.patterns[directory]
+        match = regex.fullmatch(name)
+        return sensors[match.lastindex - 1] if match else None
+
+    def existing_files(self) -> List[str]:
+        files = [f for f in self.exact if os.path.exists(f)]
+        for directory in self.patterns:
+            try:
+                with os.scandir(directory) as entries:
+                    files.extend(e.path for e in entries if self.match(e.path))
+            except OSError:
+                continue
+        return files
 
 
 class FileUsageService(BaseService):
@@ -40,40 +129,102 @@ class FileUsageService(BaseService):
     # https://unix.stackexchange.com/questions/344454/how-to-know-if-my-webcam-is-used-or-not
     # https://asyncinotify.readthedocs.io/en/latest/
 
-    def __init__(self, *, subtopic, sensors):
+    def __init__(
+        self, *, subtopic, sensors, reconcile_interval, attributes, attributes_interval
+    ):
         super().__init__()
         sensors = sensors or {}
         self.subtopic = subtopic
-        self.sensors = self.get_sensors_struct(sensors)
-        self.tracked_files = self.get_tracked_files(sensors)
+        self.reconcile_interval = reconcile_interval
+        self.attributes = attributes
+        self.attributes_interval = attributes_interval
+        self.procfs: Optional[bool] = None
+        self.sensors = list(sensors)
+        self.sensor_indexes = {sensor: i for i, sensor in enumerate(self.sensors)}
+        self.state_topics = [self.state_topic(sensor) for sensor in self.sensors]
+        # Number of files with nonzero open count per sensor
+        self.opened = array("I", [0]) * len(self.sensors)
+        # Bit per sensor, set while any of its files is opened
+        self.states = 0
+        self.files_index = FilesIndex(sensors)
+        # Sensor index and open descriptors count per file
+        self.tracked_files: Dict[str, int] = {}
+        self.open_files: Dict[str, int] = {}
+        self.watches: Dict[str, Watch] = {}
+        # Files closed by everyone counted, rechecked in /proc before OFF
+        self.rechecks: Set[str] = set()
         self.fuser_available = shutil.which("fuser")
+        # Processes holding the files, kept only with attributes enabled
+        self.holders: Dict[str, Counter] = {}
+        # Files to rescan, True if opened since the last scan
+        self.dirty_files: Dict[str, bool] = {}
+        self.dirty_sensors: Set[int] = set()
+        self.attributes_topics = []
+        if attributes:
+            self.attributes_topics = [
+                self.topic(subtopic, sensor, "attributes", sensor=sensor)
+                for sensor in self.sensors
+            ]
+        self.attributes_payloads: List[Optional[str]] = [None] * len(self.sensors)
+        self.register_sender_gen(self.start)
         self.register_discoverables()
 
     def register_discoverables(self):
 
-        for sensor in self.sensors:
+        for index, sensor in enumerate(self.sensors):
+            attributes_topic = None
+            if self.attributes:
+                attributes_topic = self.attributes_topics[index].relative
             subconfig = generate_subconfig(
                 name=sensor,
-                state_topic=self.subtopic / sensor / "state",
+                state_topic=self.state_topic(sensor).relative,
                 payload_on=ON,
                 payload_off=OFF,
+                json_attributes_topic=attributes_topic,
             )
             sensor_id = sensor
             self.register_discoverable(EntityType.BINARY_SENSOR, sensor_id, subconfig)
 
-    def get_sensors_struct(self, sensors):
-        s = {x: Sensor() for x in sensors}
-        for sensor, files in sensors.items():
-            for file in files:
-                s[sensor].entities[file] = False
-        return s
+    def track(self, inotify: Inotify, file: str, retry: bool = False) -> bool:
+        sensor = self.files_index.match(file)
+        if sensor is None or file in self.tracked_files:
+            return False
+        try:
+            self.watches[file] = inotify.add_watch(file, FILE_MASK)
+        except OSError as error:
+            if retry and isinstance(error, PermissionError):
+                # Access may be granted later, ATTRIB event retries
+                LOG.debug(f"Can't watch {file} yet: {error}")
+            else:
+                LOG.warning(f"Can't watch {file}: {error}")
+            return False
+        self.tracked_files[file] = self.sensor_indexes[sensor]
+        self.open_files[file] = 0
+        return True
 
-    def get_tracked_files(self, sensors):
-        tracked_files = {}
-        for sensor_name, files in sensors.items():
-            for file in files:
-                tracked_files[file] = sensor_name
-        return tracked_files
+    def untrack(self, inotify: Inotify, file: str) -> int:
+        """Stop tracking file, return bit of its sensor if state changed."""
+        changed = self.set_open_count(file, 0)
+        if self.holders.pop(file, None):
+            self.dirty_sensors.add(self.tracked_files[file])
+        self.dirty_files.pop(file, None)
+        self.rechecks.discard(file)
+        del self.tracked_files[file]
+        del self.open_files[file]
+        watch = self.watches.pop(file)
+        try:
+            inotify.rm_watch(watch)
+        except (OSError, KeyError, ValueError):
+            # Already removed by kernel along with the file
+            pass
+        return changed
+
+    def watch_directories(self, inotify: Inotify) -> None:
+        for directory in self.files_index.directories:
+            try:
+                inotify.add_watch(directory, DIRECTORY_MASK)
+            except OSError as error:
+                LOG.warning(f"Can't watch directory {directory}: {error}")
 
     def discovery(self) -> List[DiscoveryEntity]:
         messages = []
@@ -96,37 +247,262 @@ class FileUsageService(BaseService):
         p = subprocess.run(["fuser", device], capture_output=True)
         return bool(p.stdout)
 
-    def set_initial_states(self):
-        for file, sensor in self.tracked_files.items():
-            if self.already_opened(file):
-                self.sensors[sensor].entities[file] = True
+    def open_holders(self, files=None, pids=None) -> Dict[str, Counter]:
+        start = time.perf_counter()
+        holders = scan_open_files(files or self.tracked_files, pids)
+        PROC_SCANS.observe(time.perf_counter() - start)
+        return holders
 
-    def get_states(self):
-        states = {}
-        for sensor in self.sensors:
-            states[sensor] = self.sensors[sensor].enabled
-        return states
+    def open_counts(self, files=None) -> Dict[str, int]:
+        files = files or self.tracked_files
+        if self.procfs:
+            holders = self.open_holders(files)
+            return {f: sum(pids.values()) for f, pids in holders.items()}
+        if not self.fuser_available:
+            LOG.warning("Neither /proc nor fuser available, assuming files closed")
+            return {}
+        return {f: int(self.already_opened(f)) for f in files}
+
+    async def reconcile(self, inotify: Inotify) -> int:
+        """Reset open counts from /proc, return bits of changed sensors.
+
+        Files with events queued during the scan keep counts from events
+        and get these events applied, as in handle_events."""
+        loop = asyncio.get_running_loop()
+        procfs = procfs_available()
+        if self.attributes and not procfs and self.procfs is not False:
+            LOG.warning("/proc is not available, processes are not published")
+        self.procfs = procfs
+        if self.attributes and self.procfs:
+            self.holders = await loop.run_in_executor(None, self.open_holders)
+            counts = {f: sum(pids.values()) for f, pids in self.holders.items()}
+            self.dirty_sensors.update(range(len(self.sensors)))
+        else:
+            counts = await loop.run_in_executor(None, self.open_counts)
+        events = self.queued_events(inotify)
+        touched = {str(event.path) for event in events}
+        states = self.states
+        for file in self.tracked_files:
+            if file not in touched:
+                self.set_open_count(file, counts.get(file, 0))
+        changed = states ^ self.states
+        if events:
+            applied, overflow = await self.handle_events(inotify, events)
+            changed ^= applied
+            if overflow:
+                changed ^= await self.reconcile(inotify)
+        return changed
+
+    def mark_dirty(self, file: str, opened: bool) -> None:
+        if self.attributes and self.procfs:
+            self.dirty_files[file] = opened or self.dirty_files.get(file, False)
+            self.dirty_sensors.add(self.tracked_files[file])
+
+    def rescan_holders(
+        self, opened: List[str], closed: List[str], pids: Set[int]
+    ) -> Dict[str, Counter]:
+        """Scan all processes for opened files and only former holders
+        for closed ones - a close can't add new holders."""
+        holders = self.open_holders(opened) if opened else {}
+        if closed:
+            holders.update(self.open_holders(closed, pids))
+        return holders
+
+    async def update_attributes(self) -> List[Message]:
+        """Refresh holders of dirty files, return changed attributes."""
+        files, self.dirty_files = self.dirty_files, {}
+        sensors, self.dirty_sensors = self.dirty_sensors, set()
+        opened = [f for f, was_opened in files.items() if was_opened]
+        closed = [f for f, was_opened in files.items() if not was_opened]
+        pids = set(chain.from_iterable(self.holders.get(f, ()) for f in closed))
+        loop = asyncio.get_running_loop()
+        holders = await loop.run_in_executor(
+            None, self.rescan_holders, opened, closed, pids
+        )
+        self.holders.update(holders)
+        affected = [f for f, s in self.tracked_files.items() if s in sensors]
+        pids = set(chain.from_iterable(self.holders.get(f, ()) for f in affected))
+        names = await loop.run_in_executor(None, process_names, pids)
+        messages = []
+        for sensor in sorted(sensors):
+            payload = self.attributes_payload(sensor, names)
+            if payload != self.attributes_payloads[sensor]:
+                self.attributes_payloads[sensor] = payload
+                messages.append(Message(self.attributes_topics[sensor], payload))
+        return messages
+
+    def attributes_payload(self, sensor: int, names: Dict[int, Optional[str]]) -> str:
+        processes: Dict[int, List[str]] = defaultdict(list)
+        for file, file_sensor in self.tracked_files.items():
+            if file_sensor == sensor:
+                for pid in self.holders.get(file, ()):
+                    processes[pid].append(file)
+        return json.dumps(
+            {
+                "processes": [
+                    {"pid": pid, "name": names.get(pid), "files": sorted(files)}
+                    for pid, files in sorted(processes.items())
+                ]
+            }
+        )
+
+    def set_open_count(self, file: str, count: int) -> int:
+        """Update count of the file, return bit of its sensor if state changed."""
+        count = max(count, 0)
+        delta = (count > 0) - (self.open_files[file] > 0)
+        self.open_files[file] = count
+        if not delta:
+            return 0
+        sensor = self.tracked_files[file]
+        opened = self.opened[sensor] + delta
+        self.opened[sensor] = opened
+        if (opened > 0) == (opened > delta):
+            return 0
+        self.states ^= 1 << sensor
+        return 1 << sensor
+
+    async def handle_event(self, inotify: Inotify, event) -> int:
+        file = str(event.path)
+        if event.mask & Mask.ISDIR:
+            return 0
+        if event.mask & (Mask.CREATE | Mask.MOVED_TO | Mask.ATTRIB):
+            if not self.track(inotify, file, retry=True):
+                return 0
+            # Someone could open new file before the watch was added
+            loop = asyncio.get_running_loop()
+            counts = await loop.run_in_executor(None, self.open_counts, [file])
+            self.mark_dirty(file, True)
+            return self.set_open_count(file, counts.get(file, 0))
+        if file not in self.tracked_files:
+            return 0
+        if event.mask & (Mask.DELETE | Mask.MOVED_FROM):
+            return self.untrack(inotify, file)
+        if event.mask & Mask.OPEN:
+            delta = 1
+        elif event.mask & Mask.CLOSE:
+            delta = -1
+        else:
+            return 0
+        self.mark_dirty(file, delta > 0)
+        count = self.open_files[file] + delta
+        if count <= 0 and self.procfs:
+            # inotify merges identical consecutive events, so several
+            # opens might have been counted as one - recheck before OFF
+            self.rechecks.add(file)
+        return self.set_open_count(file, count)
+
+    @staticmethod
+    def queued_events(inotify: Inotify) -> list:
+        """Events already waiting in the queue, read without blocking."""
+        events = []
+        while True:
+            try:
+                events.append(inotify.sync_get())
+            except BlockingIOError:
+                return events
+
+    async def recheck(self) -> Dict[str, int]:
+        """Open counts of files waiting for recheck.
+
+        Former holders are the only candidates while no open was seen
+        since they were scanned (with attributes enabled), other files
+        need the whole /proc walk."""
+        files = [f for f in self.rechecks if self.open_files[f] == 0]
+        self.rechecks.clear()
+        if not files:
+            return {}
+        known = [f for f in files if f in self.holders and not self.dirty_files.get(f)]
+        unknown = [f for f in files if f not in known]
+        pids = set(chain.from_iterable(self.holders[f] for f in known))
+        loop = asyncio.get_running_loop()
+        holders = await loop.run_in_executor(
+            None, self.rescan_holders, unknown, known, pids
+        )
+        return {f: sum(p.values()) for f, p in holders.items()}
+
+    async def handle_events(self, inotify: Inotify, events: list) -> Tuple[int, bool]:
+        """Apply events and all the ones queued after them, return bits
+        of changed sensors and whether the queue overflowed.
+
+        Recheck runs only when the queue is empty: an open queued before
+        the scan would be counted by both. Its result is applied only to
+        files without events queued during the scan for the same reason,
+        the rest go on with counts from events."""
+        changed = 0
+        overflow = False
+        while events:
+            for event in events:
+                INOTIFY_EVENTS.inc()
+                overflow |= bool(event.mask & Mask.Q_OVERFLOW)
+                changed ^= await self.handle_event(inotify, event)
+            events = self.queued_events(inotify)
+            if events or not self.rechecks:
+                continue
+            counts = await self.recheck()
+            events = self.queued_events(inotify)
+            touched = {str(event.path) for event in events}
+            for file, count in counts.items():
+                if file in self.tracked_files and file not in touched:
+                    changed ^= self.set_open_count(file, count)
+        return changed, overflow
+
+    @staticmethod
+    async def wait_events(inotify: Inotify, timeout: Optional[float]) -> None:
+        """Wait until inotify has events to read or timeout passes.
+
+        Events are read only by queued_events, so scans never race with
+        a pending read, and fd is watched only while the service idles."""
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+
+        def set_readable():
+            if not readable.done():
+                readable.set_result(None)
+
+        loop.add_reader(inotify.fd, set_readable)
+        try:
+            await asyncio.wait({readable}, timeout=timeout)
+        finally:
+            loop.remove_reader(inotify.fd)
+            readable.cancel()
 
     async def start(self):
         inotify = Inotify()
-        for f in self.tracked_files:
-            inotify.add_watch(f, Mask.OPEN | Mask.CLOSE)
-        self.set_initial_states()
-        states = self.get_states()
-        async for message in messages_for_states_generator(states, self.subtopic):
+        self.watch_directories(inotify)
+        for file in self.files_index.existing_files():
+            self.track(inotify, file)
+        await self.reconcile(inotify)
+        all_sensors = all_bits(len(self.sensors))
+        for message in bitset_messages(self.state_topics, self.states, all_sensors):
             yield message
-        async for event in inotify:
-            sensor = self.tracked_files[str(event.path)]
-            self.sensors[sensor].entities[event.path] = event.mask == Mask.OPEN
-            new_states = self.get_states()
-            states_changed = {s: st for s, st in new_states.items() if st != states[s]}
-            if states_changed:
-                for s in states_changed:
-                    sensor = self.sensors[s]
-                    state_topic = self.subtopic / s / "state"
-                    payload = ON if states_changed[s] else OFF
-                    yield Message(str(state_topic), payload)
-                states = new_states
+        loop = asyncio.get_running_loop()
+        interval = self.reconcile_interval or None
+        next_reconcile = loop.time() + interval if interval else None
+        # Attributes are published at most once per attributes_interval
+        next_attributes = loop.time()
+        while True:
+            deadlines = [next_reconcile] if next_reconcile is not None else []
+            if self.dirty_sensors:
+                if loop.time() >= next_attributes:
+                    for message in await self.update_attributes():
+                        yield message
+                    next_attributes = loop.time() + self.attributes_interval
+                else:
+                    deadlines.append(next_attributes)
+            events = self.queued_events(inotify)
+            if not events:
+                timeout = None
+                if deadlines:
+                    timeout = max(min(deadlines) - loop.time(), 0)
+                await self.wait_events(inotify, timeout)
+                events = self.queued_events(inotify)
+            changed, overflow = await self.handle_events(inotify, events)
+            if overflow or (next_reconcile and loop.time() >= next_reconcile):
+                changed ^= await self.reconcile(inotify)
+                if interval:
+                    next_reconcile = loop.time() + interval
+            for message in bitset_messages(self.state_topics, self.states, changed):
+                yield message
 
 
 class ServiceModel(ServiceBaseModel):
@@ -134,3 +510,7 @@ class ServiceModel(ServiceBaseModel):
 
     subtopic: Path = Path("file_usage_tracker")
     sensors: Dict[str, List[str]] = Field(default_factory=dict)
+    reconcile_interval: NonNegativeInt = 60
+    # Publish processes holding the files as JSON attributes of sensors
+    attributes: bool = False
+    attributes_interval: NonNegativeFloat = 2
@@ -0,0 +1,56 @@
+import asyncio
+from pathlib import Path
+
+from mqtt4w.metrics import REGISTRY
+from mqtt4w.services.common import Message, ServiceBaseModel
+from mqtt4w.services.common.baseservice import BaseService
+from mqtt4w.services.common.discovery import EntityType, generate_subconfig
+from pydantic import PositiveInt
+
+# sensor: (metric name, friendly name, unit)
+EXPOSED_METRICS = {
+    "loop_lag": ("mqtt4w_event_loop_lag_seconds", "Event loop lag", "s"),
+    "loop_stalls": ("mqtt4w_event_loop_stalls_total", "Event loop stalls", None),
+    "queue_depth": ("mqtt4w_publish_queue_depth", "Publish queue depth", None),
+    "published": ("mqtt4w_published_total", "Published messages", None),
+    "dropped": ("mqtt4w_dropped_total", "Dropped messages", None),
+}
+
+
+class MetricsService(BaseService):
+    """Publishes own performance metrics as sensors."""
+
+    def __init__(self, *, subtopic, interval):
+        super().__init__()
+        self.subtopic = subtopic
+        self.interval = interval
+        self.register_sender_gen(self.metrics_states)
+        self.register_discoverables()
+
+    def register_discoverables(self):
+        for sensor, (_, name, unit) in EXPOSED_METRICS.items():
+            subconfig = generate_subconfig(
+                name=name,
+                icon="mdi:speedometer",
+                state_topic=self.state_topic(sensor).relative,
+                unit_of_measurement=unit,
+                entity_category="diagnostic",
+            )
+            self.register_discoverable(
+                EntityType.SENSOR, f"metrics_{sensor}", subconfig
+            )
+
+    async def metrics_states(self):
+        while True:
+            for sensor, (metric_name, _, _) in EXPOSED_METRICS.items():
+                metric = REGISTRY.metrics.get(metric_name)
+                value = metric.total() if metric else 0
+                yield Message(self.state_topic(sensor), f"{value:g}")
+            await asyncio.sleep(self.interval)
+
+
+class ServiceModel(ServiceBaseModel):
+    _constructor = MetricsService
+
+    subtopic: Path = Path("metrics")
+    interval: PositiveInt = 30
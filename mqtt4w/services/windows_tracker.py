@@ -1,24 +1,36 @@
 import asyncio
-from collections import defaultdict
+import re
+from array import array
 from dataclasses import dataclass
 from pathlib import Path
-from typing import AsyncGenerator, Dict, List, Set
+from typing import AsyncGenerator, Dict, List, Optional, Tuple, Union
 
 import Xlib
-from ewmh import EWMH
-from mqtt4w.services.common import (
-    Message,
-    ServiceBaseModel,
-    messages_for_states_generator,
-)
+from mqtt4w.metrics import COUNT_BUCKETS, REGISTRY
+from mqtt4w.services.common import Message, ServiceBaseModel
 from mqtt4w.services.common.baseservice import BaseService
-from pydantic import Field
+from mqtt4w.services.common.constants import BINARY_PAYLOADS
+from mqtt4w.services.common.matching import RuleKind, RulesMatcher
+from mqtt4w.services.common.utils import all_bits, bitset_messages
+from mqtt4w.xsession import XClient
+from pydantic import BaseModel, Field, root_validator, validator
 
 ALL_WINDOWS_SUBTOPIC = "all_windows"
 ACTIVE_WINDOW_SUBTOPIC = "active_window"
 FULLSCREEN_SUBTOPIC = "fullscreen"
 TITLE_SUBTOPIC = "title"
 
+SERVICE_NAME = "windows_tracker"
+X_REQUESTS = REGISTRY.counter(
+    "mqtt4w_x_requests_total", "X requests waiting for reply", ["service"]
+)
+X_EVENTS = REGISTRY.counter("mqtt4w_x_events_total", "Handled X events", ["service"])
+X_REQUESTS_PER_UPDATE = REGISTRY.histogram(
+    "mqtt4w_windows_tracker_x_requests_per_update",
+    "X requests made to update sensors states after a batch of events",
+    buckets=COUNT_BUCKETS,
+)
+
 
 @dataclass
 class WindowParams:
@@ -26,6 +38,49 @@ class WindowParams:
     is_fullscreen: bool = False
 
 
+class WindowsIndex:
+    """Titles of the client windows and count of matching windows per sensor.
+
+    Updated incrementally, so a single window change costs one match of
+    its new title, sensors matched by the old one are remembered per
+    window. Sensors are referred by index, their states are bits of the
+    `states` integer."""
+
+    def __init__(self, sensors: List[str], matcher: RulesMatcher):
+        self.matcher = matcher
+        self.titles: Dict[int, str] = {}
+        self.window_sensors: Dict[int, Tuple[int, ...]] = {}
+        self.matches = array("I", [0]) * len(sensors)
+        self.states = 0
+
+    def __contains__(self, window_id: int) -> bool:
+        return window_id in self.titles
+
+    def update(self, window_id: int, title: str) -> None:
+        if self.titles.get(window_id) == title:
+            return
+        self._count(self.window_sensors.get(window_id, ()), -1)
+        sensors = self.matcher.match(title)
+        self.titles[window_id] = title
+        self.window_sensors[window_id] = sensors
+        self._count(sensors, 1)
+
+    def remove(self, window_id: int) -> None:
+        if self.titles.pop(window_id, None) is not None:
+            self._count(self.window_sensors.pop(window_id), -1)
+
+    def clear(self) -> None:
+        for window_id in list(self.titles):
+            self.remove(window_id)
+
+    def _count(self, sensors: Tuple[int, ...], delta: int) -> None:
+        for sensor in sensors:
+            count = self.matches[sensor] + delta
+            self.matches[sensor] = count
+            if (count > 0) != (count > delta):
+                self.states ^= 1 << sensor
+
+
 class WindowsTrackerService(BaseService):
     """Exposes information about specified windows
 
@@ -40,97 +95,225 @@ class WindowsTrackerService(BaseService):
         self,
         *,
         subtopic: Path,
+        display: Optional[str],
         expose_active_window: bool,
-        sensors: Dict[str, List[str]]
+        sensors: Dict[str, List[Union[str, Dict]]],
     ):
+        super().__init__()
         self.subtopic = subtopic
-        self.ewmh = self.create_ewmh()
+        self.x: Optional[XClient] = None
+        self.ewmh = None
         self.expose_active_window = expose_active_window
         self.sensors = list(sensors.keys())
-        self.tracked_titles = self.get_tracked_titles(sensors)
+        self.matcher = self.create_matcher(sensors)
+        self.index = WindowsIndex(self.sensors, self.matcher)
+        self.state_topics = [self.state_topic(sensor) for sensor in self.sensors]
+        self.active_window_id = None
+        self.batches: asyncio.Queue = asyncio.Queue()
+        # Set on (re)connect, index is rebuilt from _NET_CLIENT_LIST
+        self.resync = False
+        self.x_requests = 0
+        self.title_topic = self.topic(subtopic, ACTIVE_WINDOW_SUBTOPIC, TITLE_SUBTOPIC)
+        self.fullscreen_topic = self.topic(
+            subtopic, ACTIVE_WINDOW_SUBTOPIC, FULLSCREEN_SUBTOPIC
+        )
+        self.register_x_client(display, self.attach)
+        self.register_sender_gen(self.generate_message)
 
-    def create_ewmh(self) -> EWMH:
-        e = EWMH()
-        root = e.display.screen().root
-        root.change_attributes(event_mask=Xlib.X.SubstructureNotifyMask)  # type: ignore
-        return e
+    def attach(self, client: XClient) -> None:
+        self.x = client
+        self.ewmh = client.ewmh
+        display = client.display
+        self.client_list_atom = display.get_atom("_NET_CLIENT_LIST")
+        self.active_window_atom = display.get_atom("_NET_ACTIVE_WINDOW")
+        self.title_atoms = {
+            display.get_atom("_NET_WM_NAME"),
+            display.get_atom("WM_NAME"),
+        }
+        self.wm_state_atom = display.get_atom("_NET_WM_STATE")
+        client.select_input(
+            display.screen().root,
+            Xlib.X.SubstructureNotifyMask | Xlib.X.PropertyChangeMask,
+        )
+        client.subscribe(
+            self.batches.put_nowait, Xlib.X.PropertyNotify, Xlib.X.DestroyNotify
+        )
+        self.resync = True
+        self.batches.put_nowait([])
 
-    def get_tracked_titles(self, sensors: Dict[str, List[str]]) -> Dict[str, List[str]]:
-        tracked_titles = defaultdict(lambda: [])
-        for sensor_name, titles in sensors.items():
+    def create_matcher(
+        self, sensors: Dict[str, List[Union[str, Dict]]]
+    ) -> RulesMatcher:
+        """Plain strings are exact titles, dicts are TitleRuleModel rules."""
+        rules = []
+        for sensor_index, titles in enumerate(sensors.values()):
             for title in titles:
-                tracked_titles[title].append(sensor_name)
-        return tracked_titles
+                if isinstance(title, str):
+                    rules.append((RuleKind.EQUALS, title, False, sensor_index))
+                    continue
+                rule = TitleRuleModel.parse_obj(title)
+                kind, pattern = rule.kind()
+                rules.append((kind, pattern, rule.ignore_case, sensor_index))
+        return RulesMatcher(rules)
 
-    def all_windows_titles(self) -> Set[str]:
-        titles = set()
-        client_list = self.ewmh.getClientList()
-        for window in client_list:
-            try:
-                window_title = self.ewmh.getWmName(window).decode()  # type: ignore
-            except Xlib.error.BadWindow:  # type: ignore
-                continue
+    def count_requests(self, count: int = 1) -> None:
+        self.x_requests += count
+        X_REQUESTS.inc(SERVICE_NAME, amount=count)
+
+    def window_title(self, window) -> Optional[str]:
+        self.count_requests()
+        try:
+            title = self.ewmh.getWmName(window)
+        except Xlib.error.BadWindow:  # type: ignore
+            return None
+        return title.decode() if title else ""
+
+    def watch_window(self, window) -> None:
+        self.x.select_input(
+            window, Xlib.X.PropertyChangeMask | Xlib.X.StructureNotifyMask
+        )
+        title = self.window_title(window)
+        if title is not None:
+            self.index.update(window.id, title)
+
+    def update_client_list(self) -> None:
+        """Sync index with _NET_CLIENT_LIST, touching only changed windows."""
+        self.count_requests()
+        client_list = {w.id: w for w in self.ewmh.getClientList()}
+        for window_id in set(self.index.titles) - client_list.keys():
+            self.index.remove(window_id)
+            self.x.forget_window(window_id)
+        for window_id, window in client_list.items():
+            if window_id not in self.index:
+                self.watch_window(window)
+
+    def handle_event(self, event) -> bool:
+        """Apply X event to the index.
+
+        Returns True if active window parameters should be refreshed."""
+        if event.type == Xlib.X.DestroyNotify:
+            self.index.remove(event.window.id)
+            self.x.forget_window(event.window.id)
+            return event.window.id == self.active_window_id
+        if event.type != Xlib.X.PropertyNotify:
+            return False
+        window_id = event.window.id
+        if event.atom == self.client_list_atom:
+            self.update_client_list()
+            return False
+        if event.atom == self.active_window_atom:
+            return True
+        if event.atom in self.title_atoms and window_id in self.index:
+            title = self.window_title(event.window)
+            if title is None:
+                self.index.remove(window_id)
             else:
-                titles.add(window_title)
-        return titles
+                self.index.update(window_id, title)
+        return window_id == self.active_window_id and (
+            event.atom in self.title_atoms or event.atom == self.wm_state_atom
+        )
 
     def get_active_window_params(self) -> WindowParams:
+        self.count_requests(3)
         window = self.ewmh.getActiveWindow()
+        if window is None:
+            self.active_window_id = None
+            return WindowParams()
+        self.active_window_id = window.id
         try:
-            name = self.ewmh.getWmName(window).decode()  # type: ignore
+            name = self.ewmh.getWmName(window)
             params = self.ewmh.getWmState(window, str=True)
         except Xlib.error.BadWindow:  # type: ignore
             return WindowParams()
-        is_fullscreen = "_NET_WM_STATE_FULLSCREEN" in params
-        return WindowParams(name, is_fullscreen)
-
-    def sensors_states(self):
-        states = {x: False for x in self.sensors}
-        for title in self.all_windows_titles():
-            if title in self.tracked_titles:
-                for sensor in self.tracked_titles[title]:
-                    states[sensor] = True
-        return states
+        is_fullscreen = "_NET_WM_STATE_FULLSCREEN" in (params or [])
+        return WindowParams(name.decode() if name else "", is_fullscreen)
 
     async def generate_message(self) -> AsyncGenerator[Message, None]:
-        states = self.sensors_states()
+        states = None
         active_win_title = ""
         active_win_fullscreen = False
-        async for message in messages_for_states_generator(states, self.subtopic):
-            yield message
-        loop = asyncio.get_running_loop()
+        all_sensors = all_bits(len(self.sensors))
         while True:
-            window_params = self.get_active_window_params()
+            events = await self.batches.get()
+            while not self.batches.empty():
+                events.extend(self.batches.get_nowait())
+            refresh_active_window = False
+            requests_before = self.x_requests
+            try:
+                if self.resync:
+                    self.resync = False
+                    self.index.clear()
+                    self.update_client_list()
+                    refresh_active_window = True
+                for event in events:
+                    refresh_active_window |= self.handle_event(event)
+                if refresh_active_window:
+                    window_params = self.get_active_window_params()
+            except Xlib.error.ConnectionClosedError:  # type: ignore
+                # Session reconnects and attaches again, which resyncs
+                continue
+            X_EVENTS.inc(SERVICE_NAME, amount=len(events))
+            X_REQUESTS_PER_UPDATE.observe(self.x_requests - requests_before)
+            new_states = self.index.states
+            changed = all_sensors if states is None else new_states ^ states
+            for message in bitset_messages(self.state_topics, new_states, changed):
+                yield message
+            states = new_states
+            if not refresh_active_window:
+                continue
             if self.expose_active_window:
                 new_active_win_title = window_params.title
                 if active_win_title != new_active_win_title:
                     active_win_title = new_active_win_title
-                    yield Message(
-                        str(self.subtopic / ACTIVE_WINDOW_SUBTOPIC / TITLE_SUBTOPIC),
-                        active_win_title,
-                    )
+                    yield Message(self.title_topic, active_win_title)
             new_active_win_fullscreen = window_params.is_fullscreen
             if new_active_win_fullscreen != active_win_fullscreen:
                 active_win_fullscreen = new_active_win_fullscreen
                 yield Message(
-                    str(self.subtopic / ACTIVE_WINDOW_SUBTOPIC / FULLSCREEN_SUBTOPIC),
-                    "ON" if active_win_fullscreen else "OFF",
+                    self.fullscreen_topic, BINARY_PAYLOADS[active_win_fullscreen]
                 )
-            # await asyncio.to_thread(self.ewmh.display.next_event)
-            await loop.run_in_executor(None, self.ewmh.display.next_event)
-            new_states = self.sensors_states()
-            changed = {t: v for t, v in new_states.items() if v != states[t]}
-            if changed:
-                async for message in messages_for_states_generator(
-                    changed, self.subtopic
-                ):
-                    yield message
-            states = new_states
+
+
+class TitleRuleModel(BaseModel):
+    """Exactly one of the title patterns."""
+
+    equals: Optional[str] = None
+    contains: Optional[str] = None
+    glob: Optional[str] = None
+    regex: Optional[str] = None
+    ignore_case: bool = False
+
+    @validator("regex")
+    def check_regex(cls, regex):
+        if regex is not None:
+            try:
+                re.compile(regex)
+            except re.error as error:
+                raise ValueError(f"Invalid regex {regex!r}: {error}")
+        return regex
+
+    @root_validator
+    def check_single_pattern(cls, values):
+        patterns = [k for k in RuleKind if values.get(k.value) is not None]
+        if len(patterns) != 1:
+            kinds = ", ".join(k.value for k in RuleKind)
+            raise ValueError(f"Title rule needs exactly one of {kinds}")
+        return values
+
+    def kind(self) -> Tuple[RuleKind, str]:
+        for kind in RuleKind:
+            pattern = getattr(self, kind.value)
+            if pattern is not None:
+                return kind, pattern
+        raise ValueError("Empty title rule")
 
 
 class ServiceModel(ServiceBaseModel):
     _constructor = WindowsTrackerService
 
     subtopic: Path = Path("windows_tracker")
+    # X display, workstation's display or $DISPLAY if not set
+    display: Optional[str] = None
     expose_active_window: bool = True
-    sensors: Dict[str, List[str]] = Field(default_factory=dict)
+    # Plain string matches the whole title
+    sensors: Dict[str, List[Union[str, TitleRuleModel]]] = Field(default_factory=dict)
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from asyncio_mqtt.client import Client
+
+from mqtt4w.config import Config, WorkstationModel
+from mqtt4w.manager import (
+    ServicesManager,
+    run_until_failure,
+    sync_discovery,
+    watch_connection,
+    watch_homeassistant,
+)
+from mqtt4w.publisher import Publisher
+from mqtt4w.registry import ServiceTiming, create_services
+from mqtt4w.scheduler import Scheduler
+from mqtt4w.services.common.baseservice import BaseService
+from mqtt4w.services.common.constants import ONLINE
+from mqtt4w.services.common.topics import normalize_level
+from mqtt4w.xsession import XSessions
+
+LOG = logging.getLogger(__name__)
+
+
+@dataclass
+class Workstation:
+    config: WorkstationModel
+    manager: ServicesManager
+    # Configuration sections and services created from them, by name
+    sections: Dict[str, Dict[str, Any]]
+    services: Dict[str, BaseService]
+
+
+class Workstations:
+    """Workstations served by the daemon over one MQTT connection.
+
+    Publisher, probes scheduler, receivers executor and X sessions are
+    shared, each workstation adds only its services, topics and device.
+    Availability topic of the connection (its last will) is named after
+    the base workstation_name, with several workstations it is listed
+    in discovery along with availability topic of each workstation."""
+
+    def __init__(
+        self,
+        config: Config,
+        publisher: Publisher,
+        timings: Optional[List[ServiceTiming]] = None,
+    ):
+        base = config.base
+        self.availability_topic = (
+            base.base_topic
+            / normalize_level(base.workstation_name)
+            / base.availability_subtopic
+        )
+        self.publisher = publisher
+        self.scheduler = Scheduler(base.probe_threads)
+        self.scheduler_task: Optional[asyncio.Task] = None
+        self.receivers_executor = ThreadPoolExecutor(
+            max_workers=base.receiver_threads, thread_name_prefix="receiver"
+        )
+        self.x_sessions = XSessions()
+        self.workstations: Dict[str, Workstation] = {}
+        for workstation in config.workstation_configs():
+            name = workstation.workstation_name
+            self.workstations[name] = self.create_workstation(
+                config, workstation, timings
+            )
+
+    def create_workstation(
+        self,
+        config: Config,
+        workstation: WorkstationModel,
+        timings: Optional[List[ServiceTiming]],
+    ) -> Workstation:
+        sections = dict(workstation.services.enabled())
+        services = create_services(sections.items(), timings)
+        settings = {
+            **config.base.dict(),
+            "workstation_name": workstation.workstation_name,
+            "workstation_id": workstation.workstation_id,
+        }
+        manager = ServicesManager(
+            self.publisher,
+            services,
+            **settings,
+            display=workstation.display,
+            connection_availability_topic=self.availability_topic,
+            scheduler=self.scheduler,
+            receivers_executor=self.receivers_executor,
+            x_sessions=self.x_sessions,
+        )
+        return Workstation(
+            workstation, manager, sections, dict(zip(sections, services))
+        )
+
+    def start_services(self) -> None:
+        self.scheduler_task = asyncio.ensure_future(self.scheduler.run())
+        self.scheduler_task.add_done_callback(self._scheduler_done)
+        for workstation in self:
+            workstation.manager.start_services()
+
+    def _scheduler_done(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception():
+            LOG.error("Probes scheduler failed", exc_info=task.exception())
+
+    async def serve(self, client: Client) -> None:
+        """Publish through the client until connection is lost.
+
+        Retained discovery configs and Home Assistant status are listened
+        to once for all workstations, paho keeps one callback per filter."""
+        managers = [w.manager for w in self]
+        self.publisher.attach(client)
+        try:
+            if all(m.availability_topic != self.availability_topic for m in managers):
+                # Last will topic listed in discovery of every workstation
+                await client.publish(
+                    str(self.availability_topic), ONLINE, qos=1, retain=True
+                )
+            await run_until_failure(
+                self.publisher.run(),
+                watch_connection(client),
+                watch_homeassistant(client, managers),
+                sync_discovery(client, managers),
+                *(manager.serve_workstation(client) for manager in managers),
+            )
+        finally:
+            self.publisher.detach()
+
+    def __iter__(self):
+        return iter(self.workstations.values())
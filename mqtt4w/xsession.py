@@ -0,0 +1,291 @@
+import asyncio
+import logging
+import os
+import threading
+from collections import defaultdict
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional
+
+from mqtt4w.metrics import REGISTRY
+
+if TYPE_CHECKING:
+    from ewmh import EWMH
+
+LOG = logging.getLogger(__name__)
+
+RECONNECT_DELAY = 5
+
+X_CONNECTIONS = REGISTRY.gauge("mqtt4w_x_connections", "Open X connections")
+X_SUBSCRIBERS = REGISTRY.gauge(
+    "mqtt4w_x_subscribers", "X event subscribers", ["display"]
+)
+
+EventsCallback = Callable[[list], None]
+
+
+class XEventReader(threading.Thread):
+    """Blocks on the X connection in a dedicated thread.
+
+    All events pending after a wake-up are drained at once and handed
+    to the event loop as a single batch."""
+
+    def __init__(self, display, loop: asyncio.AbstractEventLoop, callback, lost):
+        super().__init__(name="x-event-reader", daemon=True)
+        self.display = display
+        self.loop = loop
+        self.callback = callback
+        self.lost = lost
+
+    def run(self):
+        import Xlib.error
+
+        try:
+            while True:
+                events = [self.display.next_event()]
+                while self.display.pending_events():
+                    events.append(self.display.next_event())
+                self.loop.call_soon_threadsafe(self.callback, events)
+        except Xlib.error.ConnectionClosedError:  # type: ignore
+            try:
+                self.loop.call_soon_threadsafe(self.lost, self.display)
+            except RuntimeError:
+                # Event loop is already closed
+                pass
+
+
+class XClient:
+    """Part of a shared session used by one service.
+
+    Subscriptions and selected inputs belong to the current connection,
+    `attach` is called again to renew them after reconnect."""
+
+    def __init__(self, session: "XSession", owner, attach: Callable):
+        self.session = session
+        self.owner = owner
+        self.attach = attach
+        self.subscriptions: Dict[int, List[EventsCallback]] = defaultdict(list)
+        self.masks: Dict[int, int] = {}
+
+    @property
+    def display(self):
+        return self.session.display
+
+    @property
+    def ewmh(self):
+        return self.session.ewmh
+
+    def subscribe(self, callback: EventsCallback, *event_types: int) -> None:
+        """Get batches of events of given types on the event loop."""
+        for event_type in event_types:
+            self.subscriptions[event_type].append(callback)
+        self.session.update_subscribers()
+
+    def select_input(self, window, mask: int) -> None:
+        """Add events of the window to the ones other clients selected.
+
+        X keeps a single event mask per window and connection, so masks
+        of all clients are merged."""
+        self.masks[window.id] = mask
+        self.session.update_mask(window)
+
+    def forget_window(self, window_id: int) -> None:
+        self.masks.pop(window_id, None)
+        self.session.forget_window(window_id)
+
+    def extension_event(self, extension: str, offset: int = 0) -> Optional[int]:
+        """Type of extension event, None if the server lacks extension."""
+        info = self.display.query_extension(extension)
+        return info.first_event + offset if info else None
+
+    def reset(self) -> None:
+        self.subscriptions.clear()
+        self.masks.clear()
+
+
+class XSession:
+    """Connection to one X display shared by all X-based services.
+
+    Single reader thread blocks on the connection and fans events out
+    to subscribed clients on the event loop, any number of services
+    costs one socket and one thread. Lost connection is reopened every
+    RECONNECT_DELAY seconds."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.display = None
+        self.ewmh: Optional["EWMH"] = None
+        self.clients: List[XClient] = []
+        self.subscribers: Dict[int, List[EventsCallback]] = {}
+        # Windows with events selected by clients and merged masks
+        self.windows: Dict[int, object] = {}
+        self.window_masks: Dict[int, int] = {}
+        self.reconnect_handle: Optional[asyncio.TimerHandle] = None
+        # Display is unreachable and it's already logged
+        self.outage = False
+
+    def __bool__(self) -> bool:
+        return bool(self.clients)
+
+    @property
+    def connected(self) -> bool:
+        return self.display is not None
+
+    def open(self) -> None:
+        # Xlib takes a while to import, only sessions in use load it.
+        # Display is shared by the reader thread, the event loop and
+        # executors, Xlib.threaded makes it use real locks
+        import Xlib.threaded  # noqa: F401
+        import Xlib.display
+        from ewmh import EWMH
+
+        self.display = Xlib.display.Display(self.name or None)
+        self.ewmh = EWMH(_display=self.display)
+
+    def connect(self) -> bool:
+        import Xlib.error
+
+        loop = asyncio.get_running_loop()
+        try:
+            self.open()
+        except (OSError, Xlib.error.DisplayError) as error:
+            if self.outage:
+                LOG.debug(f"Can't open display {self.name}: {error}")
+            else:
+                LOG.warning(
+                    f"Can't open display {self.name}: {error}, "
+                    f"retrying every {RECONNECT_DELAY} s"
+                )
+                self.outage = True
+            self.reconnect_later()
+            return False
+        self.outage = False
+        X_CONNECTIONS.set(X_CONNECTIONS.value() + 1)
+        self.windows.clear()
+        self.window_masks.clear()
+        XEventReader(self.display, loop, self.dispatch, self.connection_lost).start()
+        LOG.info(f"Connected to display {self.name}")
+        for client in list(self.clients):
+            self.attach(client)
+        return True
+
+    def reconnect_later(self) -> None:
+        loop = asyncio.get_running_loop()
+        self.reconnect_handle = loop.call_later(RECONNECT_DELAY, self.reconnect)
+
+    def reconnect(self) -> None:
+        self.reconnect_handle = None
+        if self.clients and not self.connected:
+            self.connect()
+
+    def attach(self, client: XClient) -> None:
+        client.reset()
+        try:
+            client.attach(client)
+        except Exception:
+            LOG.exception(f"Failed to attach {type(client.owner).__name__} to X")
+        self.update_subscribers()
+
+    def add_client(self, owner, attach: Callable[[XClient], None]) -> XClient:
+        client = XClient(self, owner, attach)
+        self.clients.append(client)
+        if self.connected:
+            self.attach(client)
+        elif not self.reconnect_handle:
+            self.connect()
+        return client
+
+    def remove_clients(self, owner) -> None:
+        for client in [c for c in self.clients if c.owner is owner]:
+            self.clients.remove(client)
+            if self.connected:
+                for window_id in client.masks:
+                    if window_id in self.windows:
+                        self.update_mask(self.windows[window_id])
+        self.update_subscribers()
+
+    def update_subscribers(self) -> None:
+        subscribers = defaultdict(list)
+        for client in self.clients:
+            for event_type, callbacks in client.subscriptions.items():
+                subscribers[event_type].extend(callbacks)
+        self.subscribers = dict(subscribers)
+        X_SUBSCRIBERS.set(sum(map(len, subscribers.values())), self.name)
+
+    def update_mask(self, window) -> None:
+        mask = 0
+        for client in self.clients:
+            mask |= client.masks.get(window.id, 0)
+        if self.window_masks.get(window.id) != mask:
+            import Xlib.error
+
+            window.change_attributes(
+                event_mask=mask, onerror=Xlib.error.CatchError()  # type: ignore
+            )
+        if mask:
+            self.windows[window.id] = window
+            self.window_masks[window.id] = mask
+        else:
+            self.forget_window(window.id)
+
+    def forget_window(self, window_id: int) -> None:
+        if not any(window_id in client.masks for client in self.clients):
+            self.windows.pop(window_id, None)
+            self.window_masks.pop(window_id, None)
+
+    def dispatch(self, events: list) -> None:
+        batches: Dict[EventsCallback, list] = {}
+        for event in events:
+            for callback in self.subscribers.get(event.type, ()):
+                batches.setdefault(callback, []).append(event)
+        for callback, batch in batches.items():
+            callback(batch)
+
+    def connection_lost(self, display) -> None:
+        if display is not self.display:
+            # Closed by us
+            return
+        LOG.warning(f"Connection to display {self.name} lost, reconnecting")
+        self.outage = True
+        self.display = None
+        self.ewmh = None
+        X_CONNECTIONS.set(X_CONNECTIONS.value() - 1)
+        self.reconnect_later()
+
+    def close(self) -> None:
+        if self.reconnect_handle:
+            self.reconnect_handle.cancel()
+            self.reconnect_handle = None
+        display, self.display, self.ewmh = self.display, None, None
+        if display is not None:
+            X_CONNECTIONS.set(X_CONNECTIONS.value() - 1)
+            display.close()
+
+
+class XSessions:
+    """Sessions by display, created on first use and closed after last."""
+
+    session_class = XSession
+
+    def __init__(self):
+        self.sessions: Dict[str, XSession] = {}
+
+    @staticmethod
+    def display_name(name: Optional[str]) -> str:
+        return name or os.environ.get("DISPLAY", "")
+
+    def add_client(self, name: Optional[str], owner, attach) -> XClient:
+        name = self.display_name(name)
+        if name not in self.sessions:
+            self.sessions[name] = self.session_class(name)
+        return self.sessions[name].add_client(owner, attach)
+
+    def remove_clients(self, owner) -> None:
+        for name, session in list(self.sessions.items()):
+            session.remove_clients(owner)
+            if not session:
+                session.close()
+                del self.sessions[name]
+
+    def close(self) -> None:
+        for session in self.sessions.values():
+            session.close()
+        self.sessions.clear()
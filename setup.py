@@ -20,6 +20,9 @@ setup(
         "pyxdg == 0.28",
         "pyyaml == 6.0",
     ],
+    extras_require={
+        "uvloop": ["uvloop"],
+    },
     entry_points={
         "console_scripts": [
             "mqtt4w = mqtt4w.cli:main",
@@ -0,0 +1,46 @@
+from mqtt4w.services.common.matching import RuleKind, RulesMatcher
+
+
+def test_kinds():
+    matcher = RulesMatcher(
+        [
+            (RuleKind.EQUALS, "Terminal", False, 0),
+            (RuleKind.CONTAINS, "Firefox", False, 1),
+            (RuleKind.CONTAINS, "zoom", True, 2),
+            (RuleKind.GLOB, "*.pdf - *", False, 3),
+            (RuleKind.REGEX, r"^Call \d+$", False, 4),
+        ]
+    )
+    assert matcher.match("Terminal") == (0,)
+    assert matcher.match("Mozilla Firefox") == (1,)
+    assert matcher.match("ZOOM Meeting") == (2,)
+    assert matcher.match("paper.pdf - Viewer") == (3,)
+    assert matcher.match("Call 42") == (4,)
+    assert matcher.match("Zoom - Firefox") == (1, 2)
+    assert matcher.match("Editor") == ()
+
+
+def test_regex_with_named_group():
+    matcher = RulesMatcher(
+        [
+            (RuleKind.REGEX, r"Call (?P<number>\d+)", False, 0),
+            (RuleKind.CONTAINS, "meet", True, 1),
+        ]
+    )
+    assert matcher.match("Call 42") == (0,)
+    assert matcher.match("Meet") == (1,)
+    assert matcher.match("Editor") == ()
+
+
+def test_glob_with_several_wildcards():
+    # fnmatch.translate of Python 3.9/3.10 adds named groups for them
+    matcher = RulesMatcher(
+        [
+            (RuleKind.GLOB, "*Zoom*Meeting*", False, 0),
+            (RuleKind.GLOB, "*Slack*call*", True, 1),
+        ]
+    )
+    assert matcher.match("Zoom Meeting") == (0,)
+    assert matcher.match("My Zoom Team Meeting 1") == (0,)
+    assert matcher.match("slack | Call") == (1,)
+    assert matcher.match("Zoom") == ()